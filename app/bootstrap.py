@@ -6,10 +6,31 @@ This script bootstraps a PostgreSQL DB with data from the O'Reilly API endpoint.
 
 __author__ = "Bradley Frank"
 
+import bisect
+import codecs
+import collections
+import email.utils
+import hashlib
+import http.client
+import io
 import json
+import math
 import os
+import queue
+import random
+import re
 import sys
+import threading
+import time
+import unicodedata
+import urllib.parse
 import urllib.request
+import zlib
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from concurrent.futures import wait
+from contextlib import contextmanager
 from urllib.error import HTTPError
 from urllib.error import URLError
 
@@ -17,21 +38,123 @@ import logzero
 import psycopg2
 from logzero import logger
 from psycopg2 import sql
+from psycopg2.extensions import connection
 from psycopg2.extras import execute_batch
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 
 # Set this to False to quiesce logzero debugging.
 DEBUG = True
 
 # See https://www.oreilly.com/online-learning/integration-docs/search.html.
-API_URL = "https://learning.oreilly.com/api/v2/search/"
+API_URL = os.environ.get("OREILLY_API_URL", "https://learning.oreilly.com/api/v2/search/")
 LIMIT = 200
-TOPIC = "python"
+TOPICS = ["python"]
 FIELDS = ["isbn", "authors", "title", "description"]
 
+# Number of API pages fetched concurrently while harvesting, per topic.
+WORKERS = 4
+
+# Number of topics harvested concurrently.
+TOPIC_WORKERS = 4
+
+# Number of idle keep-alive connections kept open to each API host.
+HTTP_POOL_SIZE = 8
+
+# Seconds an API connection may wait to connect or for data before the request fails.
+HTTP_TIMEOUT = 30
+
+# Number of redirects followed for a single API request.
+MAX_REDIRECTS = 5
+
+#
+# API request pacing: a token bucket shared by all harvesting threads allows RATE_LIMIT requests
+# per second with bursts of up to RATE_BURST, and concurrency adapts between 1 and
+# WORKERS * TOPIC_WORKERS requests, halving on 429/503 responses and growing while latency
+# stays under LATENCY_TARGET seconds. Each request is attempted up to MAX_ATTEMPTS times.
+#
+RATE_LIMIT = 10
+RATE_BURST = 10
+LATENCY_TARGET = 2.0
+MAX_ATTEMPTS = 5
+
+# HTTP statuses that mean the API is overloaded or throttling, and are retried after a pause.
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# Errors that mean a request failed on the network, and are retried after a pause. Any other
+# error (e.g. an invalid URL) would fail the same way again, so it isn't retried.
+RETRY_ERRORS = (OSError, http.client.IncompleteRead)
+
+# Directory of the on-disk API response cache, revalidated with the server on every run. Set
+# this to None to disable the cache.
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+
+# Number of prepared batches of works buffered between the harvesting and loading stages.
+PIPELINE_DEPTH = 2
+
+# Number of characters read from an API response at a time while decoding it.
+READ_SIZE = 65536
+
+#
+# How books and authors are loaded:
+#   "copy"   - rows are streamed into staging tables with COPY, then moved set-based.
+#   "values" - rows are staged with multi-row INSERT ... VALUES statements instead.
+#   "rows"   - authors are inserted with multi-row INSERTs, but every book and relationship
+#              is its own statement.
+#
+LOADER = "copy"
+
+# Set this to True to store author names with Unicode (NFKC) and whitespace normalization, so
+# that e.g. "Luciano  Ramalho" and "Luciano Ramalho" are loaded as the same author.
+NORMALIZE_AUTHORS = False
+
+# Set this to True to keep the existing tables and upsert books (by ISBN, or by title for works
+# without one), authors and their relationships, instead of dropping and reloading everything.
+SYNC_MODE = False
+
+# Number of works loaded per transaction. Set to 0 to load everything, including dropping and
+# recreating the tables, in a single atomic transaction.
+CHUNK_SIZE = 0
+
+# Number of connections that load the books of each chunk concurrently. Only used when
+# CHUNK_SIZE is set, since a single atomic transaction can't span several connections.
+LOAD_CONNECTIONS = 1
+
+#
+# Set this to True to load full reloads into UNLOGGED shadow tables in LOAD_SCHEMA, which are
+# only made durable, indexed and swapped in for the live tables once they're complete. Readers
+# then see the old catalog until the new one is ready, never a partial one. Ignored in
+# SYNC_MODE, which updates the live tables in place.
+#
+SWAP_TABLES = False
+LOAD_SCHEMA = "oreilly_load"
+
+#
+# Set this to True to apply a bulk-load profile to the loader's sessions: BULK_SETTINGS are set
+# on every connection, and foreign keys are only added, and validated in one pass per table,
+# once the data is loaded, rather than checked row by row. With synchronous_commit off, a server
+# crash may lose the last few commits, but checkpoints are committed with their chunks, so a
+# resumed load is still consistent.
+#
+BULK_LOAD = False
+BULK_SETTINGS = {
+    "synchronous_commit": "off",
+    "maintenance_work_mem": "1GB",
+    "work_mem": "256MB",
+}
+
+# Upper bounds, in seconds, of the buckets of the per-kind statement latency histograms.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+# Set this to a path, e.g. in node_exporter's textfile collector directory, to export the
+# statement metrics of each run in Prometheus' text format.
+METRICS_FILE = os.environ.get("METRICS_FILE")
+
 # Database information is passed from environment.
 DB_USER = os.environ["POSTGRES_USER"]
 DB_PASSWORD = os.environ["POSTGRES_PASSWORD"]
-DB_HOST = "postgres"
+DB_HOST = os.environ.get("POSTGRES_HOST", "postgres")
+DB_PORT = os.environ.get("POSTGRES_PORT", "5432")
 DB_NAME = os.environ["POSTGRES_USER"]
 
 # Table definitions for saving API query results.
@@ -41,60 +164,1383 @@ DB_TABLES = {
         "title text NOT NULL",
         "isbn bigint",
         "description text",
+        "search_vector tsvector",
     ],
     "authors": [
         "author_id serial NOT NULL PRIMARY KEY",
         "name text NOT NULL UNIQUE",
     ],
     "books_authors": [
-        "book_id int REFERENCES books (book_id)",
-        "author_id int REFERENCES authors (author_id)",
+        "book_id int",
+        "author_id int",
         "CONSTRAINT books_authors_pkey PRIMARY KEY (book_id, author_id)",
     ],
+    "topics": [
+        "topic_id serial NOT NULL PRIMARY KEY",
+        "name text NOT NULL UNIQUE",
+    ],
+    "books_topics": [
+        "book_id int",
+        "topic_id int",
+        "CONSTRAINT books_topics_pkey PRIMARY KEY (book_id, topic_id)",
+    ],
+}
+
+#
+# Secondary indexes on the tables above. They are built once the data is loaded, which is much
+# faster than maintaining them row by row during a bulk load. Title search uses trigrams from
+# the pg_trgm extension.
+#
+DB_INDEXES = {
+    "books_isbn_key": {"table": "books", "columns": "(isbn)", "unique": True},
+    "books_title_trgm_idx": {"table": "books", "columns": "USING gin (title gin_trgm_ops)"},
+    "books_authors_author_id_idx": {"table": "books_authors", "columns": "(author_id)"},
+    "books_topics_topic_id_idx": {"table": "books_topics", "columns": "(topic_id)"},
+    "books_search_vector_idx": {"table": "books", "columns": "USING gin (search_vector)"},
 }
 
+# Text search configuration used to build and query the books' search vectors.
+SEARCH_CONFIG = "english"
+
+#
+# Ranked full-text search over the books, for readers of the DB, e.g.
+#   SELECT * FROM search_books('distributed systems');
+# Names are resolved when it's called, so it always searches the live tables.
+#
+SEARCH_FUNCTION = (
+    "CREATE OR REPLACE FUNCTION public.search_books(terms text, max_results int DEFAULT 20) "
+    "RETURNS TABLE (book_id int, title text, isbn bigint, rank real) "
+    "LANGUAGE sql STABLE AS $$ "
+    "SELECT b.book_id, b.title, b.isbn, ts_rank(b.search_vector, q) AS rank "
+    "FROM books b, plainto_tsquery('" + SEARCH_CONFIG + "', terms) q "
+    "WHERE b.search_vector @@ q ORDER BY rank DESC, b.book_id LIMIT max_results $$"
+)
+
+# Indexes from DB_INDEXES whose tables are CLUSTERed on them after loading, storing rows in
+# index order, e.g. ["books_authors_author_id_idx"] to keep each author's books together. The
+# rewrite locks out readers of the table while it runs.
+CLUSTER_INDEXES = []
+
+# Foreign keys on the tables above, added by create_foreign_keys().
+DB_FOREIGN_KEYS = {
+    "books_authors_book_id_fkey": {
+        "table": "books_authors", "columns": "(book_id)", "references": "books (book_id)"
+    },
+    "books_authors_author_id_fkey": {
+        "table": "books_authors", "columns": "(author_id)", "references": "authors (author_id)"
+    },
+    "books_topics_book_id_fkey": {
+        "table": "books_topics", "columns": "(book_id)", "references": "books (book_id)"
+    },
+    "books_topics_topic_id_fkey": {
+        "table": "books_topics", "columns": "(topic_id)", "references": "topics (topic_id)"
+    },
+}
+
+#
+# Ledger of API pages whose works have all been committed, with the topic's page count. It is
+# kept across runs, so a run that dies part way resumes from its last committed chunk; it is
+# emptied once a run completes. Only useful with CHUNK_SIZE set, as a single transaction
+# either commits everything or nothing.
+#
+CHECKPOINT_TABLES = {
+    "load_checkpoints": [
+        "topic text NOT NULL",
+        "page int NOT NULL",
+        "pages int",
+        "CONSTRAINT load_checkpoints_pkey PRIMARY KEY (topic, page)",
+    ],
+}
+
+# Session-local staging tables for bulk loading. Staged books already carry their final book_id.
+STAGE_TABLES = {
+    "stage_authors": [
+        "name text NOT NULL",
+    ],
+    "stage_books": [
+        "book_id int NOT NULL PRIMARY KEY",
+        "title text NOT NULL",
+        "isbn bigint",
+        "description text",
+    ],
+    "stage_books_authors": [
+        "book_id int NOT NULL",
+        "author_id int NOT NULL",
+    ],
+}
+
+# Conflict clause upserting books by book_id. Unchanged books are left alone, so a sync only
+# writes the rows whose data actually changed.
+UPSERT_BOOKS = (
+    "ON CONFLICT (book_id) DO UPDATE SET "
+    "title = EXCLUDED.title, isbn = EXCLUDED.isbn, description = EXCLUDED.description, "
+    "search_vector = EXCLUDED.search_vector "
+    "WHERE (books.title, books.isbn, books.description) "
+    "IS DISTINCT FROM (EXCLUDED.title, EXCLUDED.isbn, EXCLUDED.description)"
+)
+
+
+#
+# PostgreSQL 9.6 has no generated columns, so every statement that writes a book computes its
+# search vector from the title and description it writes, with the title weighted above the
+# description. Takes the SQL for both, e.g. column names or parameters.
+#
+SEARCH_VECTOR = (
+    "setweight(to_tsvector('" + SEARCH_CONFIG + "', coalesce({title}, '')), 'A') || "
+    "setweight(to_tsvector('" + SEARCH_CONFIG + "', coalesce({description}, '')), 'B')"
+)
+
+# Cache of author name -> author_id, filled as authors are inserted. Books are linked to their
+# authors through this map rather than by querying the 'authors' table.
+AUTHOR_IDS = {}
+
+# Cache of topic name -> topic_id, filled when the tables are created.
+TOPIC_IDS = {}
+
+# (book key, topic) pairs handed to the loader but not yet loaded into 'books_topics'. A work
+# found under several topics is loaded once, and each of its topics is recorded here.
+BOOK_TOPICS = []
+
+# (topic, page, pages) of API pages whose works have all been handed to the loader, but which
+# are not yet recorded in the checkpoint ledger.
+PAGES_DONE = []
+
+# A batch of unique works for the loader, with the (book key, topic) pairs and completed
+# (topic, page, pages) seen while harvesting it.
+Batch = collections.namedtuple("Batch", ["works", "book_topics", "pages"])
+
+# Cache of book key (ISBN, or title for works without one) -> book_id. Works already in the
+# cache are upserted under their existing book_id rather than inserted again.
+BOOK_IDS = {}
+
+# Characters that must be escaped in PostgreSQL's COPY text format.
+COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+#
+# A statement's kind is its verb and the first identifier it quotes, usually its table, or for
+# an EXECUTE, the name of the prepared statement.
+#
+STATEMENT_KIND = re.compile(r'\s*(\w+)[^"]*(?:"([^"]+)")?')
+EXECUTE_KIND = re.compile(r'\s*(EXECUTE)\s+(\w+)', re.IGNORECASE)
+
+
+class PgStats:
+    """Counts statements, round trips, rows and commits per statement kind, with latencies."""
+
+    #
+    # A statement is one call of pg_exec(); it takes one round trip, or one per page in batch
+    # and values modes. Latency histograms are of whole statements, including fetching their
+    # results. Every connection records into the same PgStats, from any thread.
+    #
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.kinds = {}
+        self.commits = 0
+        self.commit_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def _kind(self, kind):
+        if kind not in self.kinds:
+            self.kinds[kind] = {
+                "statements": 0,
+                "round_trips": 0,
+                "rows": 0,
+                "seconds": 0.0,
+                "histogram": [0] * (len(self.buckets) + 1),
+            }
+        return self.kinds[kind]
+
+    def round_trip(self, kind, rows):
+        """Records a round trip made by a LoaderCursor."""
+
+        with self._lock:
+            stats = self._kind(kind)
+            stats["round_trips"] += 1
+            stats["rows"] += max(rows, 0)
+
+    def statement(self, kind, seconds):
+        """Records a statement executed by pg_exec()."""
+
+        with self._lock:
+            stats = self._kind(kind)
+            stats["statements"] += 1
+            stats["seconds"] += seconds
+            stats["histogram"][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def commit(self, seconds):
+        """Records a commit made by a LoaderConnection."""
+
+        with self._lock:
+            self.commits += 1
+            self.commit_seconds += seconds
+
+    def round_trips(self):
+        """Returns the number of round trips made so far, including commits."""
+
+        with self._lock:
+            return self.commits + sum(stats["round_trips"] for stats in self.kinds.values())
+
+    def log_summary(self):
+        """Logs the stats of each statement kind, slowest first."""
+
+        for kind, stats in sorted(self.kinds.items(), key=lambda item: -item[1]["seconds"]):
+            logger.info(
+                "SQL %s: %d statements; %d round trips; %d rows; %.3fs (%.2fms each)",
+                kind,
+                stats["statements"],
+                stats["round_trips"],
+                stats["rows"],
+                stats["seconds"],
+                stats["seconds"] * 1000 / max(stats["statements"], 1),
+            )
+        logger.info("SQL commits: %d; %.3fs", self.commits, self.commit_seconds)
+
+    def write_metrics(self, path):
+        """Writes the stats to path in Prometheus' text format, replacing it atomically."""
+
+        lines = []
+
+        for name, help_text in [
+            ("statements", "Statements executed by pg_exec()."),
+            ("round_trips", "Round trips made to PostgreSQL for statements."),
+            ("rows", "Rows affected or returned by statements."),
+        ]:
+            lines.append("# HELP oreilly_pg_" + name + "_total " + help_text)
+            lines.append("# TYPE oreilly_pg_" + name + "_total counter")
+            for kind, stats in sorted(self.kinds.items()):
+                lines.append(
+                    "oreilly_pg_" + name + "_total{" + metric_label(kind) + "} " + str(stats[name])
+                )
+
+        lines.append("# HELP oreilly_pg_statement_seconds Latency of statements by kind.")
+        lines.append("# TYPE oreilly_pg_statement_seconds histogram")
+        for kind, stats in sorted(self.kinds.items()):
+            label = metric_label(kind)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), stats["histogram"]):
+                cumulative += count
+                lines.append(
+                    "oreilly_pg_statement_seconds_bucket{" + label + ',le="' + str(bound) + '"} '
+                    + str(cumulative)
+                )
+            lines.append(
+                "oreilly_pg_statement_seconds_sum{" + label + "} " + repr(stats["seconds"])
+            )
+            lines.append(
+                "oreilly_pg_statement_seconds_count{" + label + "} " + str(stats["statements"])
+            )
+
+        lines.append("# HELP oreilly_pg_commits_total Transactions committed.")
+        lines.append("# TYPE oreilly_pg_commits_total counter")
+        lines.append("oreilly_pg_commits_total " + str(self.commits))
+        lines.append("# HELP oreilly_pg_commit_seconds_total Time spent committing.")
+        lines.append("# TYPE oreilly_pg_commit_seconds_total counter")
+        lines.append("oreilly_pg_commit_seconds_total " + repr(self.commit_seconds))
+
+        # node_exporter may read the file at any time, so it must never be seen half written.
+        with open(path + ".tmp", "w") as metrics:
+            metrics.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+
+
+def metric_label(kind):
+    """Renders a statement kind as a Prometheus label."""
+
+    value = kind.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return 'kind="' + value + '"'
+
+
+def statement_kind(query):
+    """Returns the kind of a statement, such as 'INSERT books', from its SQL."""
+
+    if isinstance(query, bytes):
+        query = query[:200].decode("utf-8", "replace")
+
+    match = EXECUTE_KIND.match(query) or STATEMENT_KIND.match(query[:200])
+    verb, name = match.groups() if match else ("", None)
+
+    return verb.upper() + (" " + name if name else "")
+
+
+PG_STATS = PgStats(LATENCY_BUCKETS)
+
+
+class LoaderCursor(psycopg2.extensions.cursor):
+    """Cursor that records each round trip it makes in PG_STATS."""
+
+    # Kind of the last statement sent, for pg_exec() to record it under.
+    kind = None
+
+    def execute(self, query, params=None):
+        try:
+            return super().execute(query, params)
+        finally:
+            self._record(self.query or query)
+
+    def copy_expert(self, query, file, size=8192):
+        try:
+            return super().copy_expert(query, file, size)
+        finally:
+            self._record(query if isinstance(query, (str, bytes)) else query.as_string(self))
+
+    def _record(self, query):
+        self.kind = statement_kind(query)
+        PG_STATS.round_trip(self.kind, self.rowcount)
+
+
+class LoaderConnection(connection):
+    """Connection whose per-statement commits can be deferred to an enclosing transaction.
+
+    Its cursors and commits are recorded in PG_STATS, and it caches the SQL of Statements.
+    """
+
+    deferred = False
+    staged = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = LoaderCursor
+        # Statement name -> the SQL that runs it on this connection.
+        self.statements = {}
+
+    def commit(self):
+        start = time.perf_counter()
+        super().commit()
+        PG_STATS.commit(time.perf_counter() - start)
 
-def db_connect():
-    """Connects to a PostgreSQL DB using credentials from Docker environment variables."""
+
+def db_connect(pool_size=0):
+    """Connects to a PostgreSQL DB using credentials from Docker environment variables.
+
+    If pool_size is given, returns a thread-safe pool of that many connections instead.
+    """
 
     logger.debug("Host: %s; Name: %s; User: %s; Pass: %s", DB_HOST, DB_NAME, DB_USER, DB_PASSWORD)
 
+    params = {
+        "database": DB_NAME,
+        "user": DB_USER,
+        "password": DB_PASSWORD,
+        "host": DB_HOST,
+        "port": DB_PORT,
+        "connection_factory": LoaderConnection,
+    }
+
+    options = []
+
+    # Unqualified table names then resolve to the shadow tables first.
+    if swap_mode():
+        options.append("-c search_path=" + LOAD_SCHEMA + ",public")
+
+    if BULK_LOAD:
+        options.extend("-c " + name + "=" + value for name, value in BULK_SETTINGS.items())
+
+    if options:
+        params["options"] = " ".join(options)
+
     try:
-        conn = psycopg2.connect(
-            database=DB_NAME, user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port="5432"
-        )
+        if pool_size:
+            conn = ThreadedConnectionPool(pool_size, pool_size, **params)
+        else:
+            conn = psycopg2.connect(**params)
     except (Exception, psycopg2.DatabaseError) as err:
         print("Error connecting to PostgreSQL.")
         logger.error(err)
         sys.exit()
 
-    return conn
+    return conn
+
+
+@contextmanager
+def transaction(conn):
+    """Defers commits from pg_exec() so the enclosed statements commit or roll back as one."""
+
+    conn.deferred = True
+
+    try:
+        yield conn
+    except BaseException:
+        # pg_exec() closes the connection on errors, which discards the transaction anyway.
+        if not conn.closed:
+            conn.rollback()
+        raise
+    else:
+        try:
+            conn.commit()
+        except (Exception, psycopg2.DatabaseError) as err:
+            print("Error committing transaction.")
+            logger.error(err)
+            conn.close()
+            sys.exit()
+    finally:
+        conn.deferred = False
+
+
+def create_tables(conn, keep=False):
+    """Drops existing tables and creates new DB scaffolding, or keeps them in SYNC_MODE.
+
+    With SWAP_TABLES, these are the shadow tables in LOAD_SCHEMA, and the live tables are
+    left alone.
+    """
+
+    unlogged = "UNLOGGED " if swap_mode() else ""
+
+    # Tables are also kept when resuming an interrupted load.
+    if SYNC_MODE or keep:
+        create = "CREATE " + unlogged + "TABLE IF NOT EXISTS {pg_table} "
+    else:
+        # Shadow tables are named in full, so a missing one can't resolve to a live table.
+        schema = (LOAD_SCHEMA,) if swap_mode() else ()
+        query = sql.SQL("DROP TABLE IF EXISTS {pg_tables}").format(
+            pg_tables=sql.SQL(", ").join(sql.Identifier(*schema, table) for table in DB_TABLES),
+        )
+        pg_exec(conn, query, "Error dropping tables.")
+        create = "CREATE " + unlogged + "TABLE {pg_table} "
+
+    AUTHOR_IDS.clear()
+    BOOK_IDS.clear()
+    TOPIC_IDS.clear()
+
+    # Programatically create tables by looping through DB_TABLES dictionary.
+    for table, rows in DB_TABLES.items():
+        query = sql.SQL(create + "( " + ", ".join(rows) + " )").format(
+            pg_table=sql.Identifier(table),
+        )
+
+        pg_exec(conn, query, "Error creating tables.")
+
+    # In a bulk load, foreign keys are only added once the data is in.
+    if not BULK_LOAD:
+        create_foreign_keys(conn)
+
+    if SYNC_MODE or keep:
+        clear_missing_isbns(conn)
+        merge_duplicate_isbns(conn)
+        add_search_vectors(conn)
+        load_caches(conn)
+
+    dump_topics(conn)
+
+
+def load_checkpoints(conn):
+    """Creates the checkpoint ledger if needed, and returns it as {topic: {page: pages}}."""
+
+    # A crash empties UNLOGGED shadow tables, so it must empty their ledger too.
+    create = "CREATE UNLOGGED TABLE" if swap_mode() else "CREATE TABLE"
+
+    for table, rows in CHECKPOINT_TABLES.items():
+        query = sql.SQL(create + " IF NOT EXISTS {pg_table} " + "( " + ", ".join(rows) + " )")
+        pg_exec(conn, query.format(pg_table=sql.Identifier(table)), "Error creating tables.")
+
+    query_sel_checkpoints = sql.SQL("SELECT topic, page, pages FROM {pg_table}").format(
+        pg_table=sql.Identifier("load_checkpoints"),
+    )
+
+    checkpoints = {}
+
+    for topic, page, pages in pg_exec(
+        conn, query_sel_checkpoints, "Error selecting from 'load_checkpoints'.", fetch="all"
+    ):
+        checkpoints.setdefault(topic, {})[page] = pages
+
+    return checkpoints
+
+
+def dump_checkpoints(conn):
+    """Records every page pending in PAGES_DONE in the checkpoint ledger."""
+
+    pg_exec(
+        conn,
+        INSERT_CHECKPOINTS,
+        "Error inserting into 'load_checkpoints'.",
+        data=list(PAGES_DONE),
+        values=True,
+    )
+
+    del PAGES_DONE[:]
+
+
+def clear_checkpoints(conn):
+    """Empties the checkpoint ledger once a run has completed."""
+
+    pg_exec(
+        conn,
+        sql.SQL("DELETE FROM {pg_table}").format(pg_table=sql.Identifier("load_checkpoints")),
+        "Error deleting from 'load_checkpoints'.",
+    )
+
+
+def create_indexes(conn):
+    """Creates any secondary indexes from DB_INDEXES that don't exist yet."""
+
+    pg_exec(
+        conn, "CREATE EXTENSION IF NOT EXISTS pg_trgm SCHEMA public", "Error creating extensions."
+    )
+
+    for index, definition in DB_INDEXES.items():
+        unique = "UNIQUE " if definition.get("unique") else ""
+        query = sql.SQL(
+            "CREATE " + unique + "INDEX IF NOT EXISTS {pg_index} ON {pg_table} "
+            + definition["columns"]
+        ).format(pg_index=sql.Identifier(index), pg_table=sql.Identifier(definition["table"]))
+
+        pg_exec(conn, query, "Error creating indexes.")
+
+
+def maintain_tables(conn):
+    """Refreshes planner statistics and visibility maps after a load, timing each step.
+
+    Returns a list of (step, table, seconds).
+    """
+
+    #
+    # Freshly loaded tables have no statistics, so the planner guesses, and no visibility map,
+    # so index-only scans still visit the heap. VACUUM can't run in a transaction block, so
+    # every step runs on its own. CLUSTER rewrites its table, resetting both, so it runs first.
+    #
+
+    steps = []
+
+    for index in CLUSTER_INDEXES:
+        table = DB_INDEXES[index]["table"]
+        query = sql.SQL("CLUSTER {pg_table} USING {pg_index}").format(
+            pg_table=sql.Identifier(table), pg_index=sql.Identifier(index),
+        )
+        steps.append(("CLUSTER", table, query))
+
+    for step in ["ANALYZE", "VACUUM"]:
+        for table in DB_TABLES:
+            query = sql.SQL(step + " {pg_table}").format(pg_table=sql.Identifier(table))
+            steps.append((step, table, query))
+
+    timings = []
+    conn.autocommit = True
+
+    try:
+        for step, table, query in steps:
+            start = time.perf_counter()
+            pg_exec(conn, query, "Error running " + step + " on '" + table + "'.")
+            timings.append((step, table, time.perf_counter() - start))
+            logger.info("%s %s: %.3fs", step, table, timings[-1][2])
+    finally:
+        # pg_exec() closes the connection on errors.
+        if not conn.closed:
+            conn.autocommit = False
+
+    return timings
+
+
+def swap_mode():
+    """Returns whether tables are loaded in LOAD_SCHEMA and swapped in once complete."""
+
+    return SWAP_TABLES and not SYNC_MODE
+
+
+def create_load_schema(conn):
+    """Creates LOAD_SCHEMA, which holds the shadow tables and their checkpoint ledger."""
+
+    pg_exec(
+        conn,
+        sql.SQL("CREATE SCHEMA IF NOT EXISTS {pg_schema}").format(
+            pg_schema=sql.Identifier(LOAD_SCHEMA),
+        ),
+        "Error creating schema.",
+    )
+
+
+def set_logged(conn):
+    """Makes the UNLOGGED shadow tables durable, before their indexes are built."""
+
+    # Each table is rewritten into the WAL in one pass. A logged table can't reference an
+    # unlogged one, so tables are converted in DB_TABLES order, referenced tables first.
+    for table in DB_TABLES:
+        query = sql.SQL("ALTER TABLE {pg_table} SET LOGGED").format(
+            pg_table=sql.Identifier(LOAD_SCHEMA, table),
+        )
+
+        pg_exec(conn, query, "Error setting tables logged.")
+
+
+def swap_tables(conn):
+    """Replaces the live tables with the shadow tables, moving them out of LOAD_SCHEMA."""
+
+    #
+    # Only the catalog changes, so this holds its locks on the live tables for moments, and
+    # readers see the old tables until it commits. Indexes, constraints and sequences move
+    # with their tables.
+    #
+
+    query_drop = sql.SQL("DROP TABLE IF EXISTS {pg_tables}").format(
+        pg_tables=sql.SQL(", ").join(sql.Identifier("public", table) for table in DB_TABLES),
+    )
+
+    pg_exec(conn, query_drop, "Error dropping tables.")
+
+    for table in DB_TABLES:
+        query = sql.SQL("ALTER TABLE {pg_table} SET SCHEMA public").format(
+            pg_table=sql.Identifier(LOAD_SCHEMA, table),
+        )
+
+        pg_exec(conn, query, "Error swapping tables.")
+
+
+def add_search_vectors(conn):
+    """Adds search vectors to a 'books' table created before they existed."""
+
+    #
+    # Unchanged books are never rewritten by the upserts, so vectors missing from existing
+    # rows are filled in here. Once they all have one, this only costs a scan of the table.
+    #
+
+    pg_exec(
+        conn,
+        "ALTER TABLE books ADD COLUMN IF NOT EXISTS search_vector tsvector",
+        "Error altering 'books'.",
+    )
+    pg_exec(
+        conn,
+        "UPDATE books SET search_vector = "
+        + SEARCH_VECTOR.format(title="title", description="description")
+        + " WHERE search_vector IS NULL",
+        "Error updating 'books'.",
+    )
+
+
+def create_search_function(conn):
+    """Creates or replaces the search_books() function over the books' search vectors."""
+
+    pg_exec(conn, SEARCH_FUNCTION, "Error creating functions.")
+
+
+def create_foreign_keys(conn):
+    """Adds any foreign keys from DB_FOREIGN_KEYS that don't exist yet, then validates them."""
+
+    #
+    # Keys are added NOT VALID, which only checks rows written from then on, and then validated
+    # with a single scan of each table. Outside a transaction() each ADD commits before its
+    # validation starts, so the scan doesn't block reads or writes; inside one, the lock taken
+    # by ADD is held until the end. Keys left NOT VALID by an interrupted run are validated too.
+    #
+
+    query_sel_keys = (
+        "SELECT conname, convalidated FROM pg_constraint "
+        "WHERE contype = 'f' AND conrelid = ANY(%s::regclass[])"
+    )
+
+    tables = sorted({definition["table"] for definition in DB_FOREIGN_KEYS.values()})
+    existing = dict(
+        pg_exec(
+            conn, query_sel_keys, "Error selecting foreign keys.", data=[tables], fetch="all"
+        )
+    )
+
+    for key, definition in DB_FOREIGN_KEYS.items():
+        if key in existing:
+            continue
+        query = sql.SQL(
+            "ALTER TABLE {pg_table} ADD CONSTRAINT {pg_key} FOREIGN KEY " + definition["columns"]
+            + " REFERENCES " + definition["references"] + " NOT VALID"
+        ).format(pg_table=sql.Identifier(definition["table"]), pg_key=sql.Identifier(key))
+
+        pg_exec(conn, query, "Error adding foreign keys.")
+
+    for key, definition in DB_FOREIGN_KEYS.items():
+        if existing.get(key):
+            continue
+        query = sql.SQL("ALTER TABLE {pg_table} VALIDATE CONSTRAINT {pg_key}").format(
+            pg_table=sql.Identifier(definition["table"]), pg_key=sql.Identifier(key),
+        )
+
+        pg_exec(conn, query, "Error validating foreign keys.")
+
+
+def clear_missing_isbns(conn):
+    """Replaces the 0 that earlier versions stored for a missing ISBN with NULL."""
+
+    # Works without an ISBN are keyed by title, so they only match their rows once NULL.
+    pg_exec(
+        conn,
+        sql.SQL("UPDATE {pg_table} SET isbn = NULL WHERE isbn = 0").format(
+            pg_table=sql.Identifier("books"),
+        ),
+        "Error updating 'books'.",
+    )
+
+
+def merge_duplicate_isbns(conn):
+    """Merges books sharing an ISBN into the one with the lowest book_id."""
+
+    #
+    # Tables from before books_isbn_key may hold several books per ISBN, which would stop the
+    # unique index from being built. Each duplicate's relationships move to the book that is
+    # kept, then the duplicate itself is deleted.
+    #
+
+    query_sel_duplicates = sql.SQL(
+        "SELECT b.book_id, min(o.book_id) FROM {pg_table} b JOIN {pg_table} o "
+        "ON o.isbn = b.isbn AND o.book_id < b.book_id GROUP BY b.book_id"
+    ).format(pg_table=sql.Identifier("books"))
+
+    duplicates = pg_exec(
+        conn, query_sel_duplicates, "Error selecting from 'books'.", fetch="all"
+    )
+
+    if not duplicates:
+        return
+
+    for table, column in [("books_authors", "author_id"), ("books_topics", "topic_id")]:
+        query_ins_links = sql.SQL(
+            "INSERT INTO {pg_table} (book_id, {pg_column}) "
+            "SELECT d.keep, t.{pg_column} FROM {pg_table} t "
+            "JOIN (VALUES %s) AS d (book_id, keep) ON t.book_id = d.book_id "
+            "ON CONFLICT DO NOTHING"
+        ).format(pg_table=sql.Identifier(table), pg_column=sql.Identifier(column))
+        query_del_links = sql.SQL("DELETE FROM {pg_table} WHERE book_id = ANY(%s)").format(
+            pg_table=sql.Identifier(table),
+        )
+
+        pg_exec(
+            conn,
+            query_ins_links,
+            "Error inserting into '" + table + "'.",
+            data=duplicates,
+            values=True,
+        )
+        pg_exec(
+            conn,
+            query_del_links,
+            "Error deleting from '" + table + "'.",
+            data=[[book_id for book_id, _ in duplicates]],
+        )
+
+    pg_exec(
+        conn,
+        sql.SQL("DELETE FROM {pg_table} WHERE book_id = ANY(%s)").format(
+            pg_table=sql.Identifier("books"),
+        ),
+        "Error deleting from 'books'.",
+        data=[[book_id for book_id, _ in duplicates]],
+    )
+
+    logger.info("Merged %d book(s) with a duplicate ISBN.", len(duplicates))
+
+
+def load_caches(conn):
+    """Fills AUTHOR_IDS and BOOK_IDS from the existing tables, one query each."""
+
+    query_sel_authors = sql.SQL("SELECT author_id, name FROM {pg_table}").format(
+        pg_table=sql.Identifier("authors"),
+    )
+
+    for author_id, name in pg_exec(
+        conn, query_sel_authors, "Error selecting from 'authors'.", fetch="all"
+    ):
+        AUTHOR_IDS[name] = author_id
+
+    query_sel_books = sql.SQL("SELECT book_id, isbn, title FROM {pg_table}").format(
+        pg_table=sql.Identifier("books"),
+    )
+
+    for book_id, isbn, title in pg_exec(
+        conn, query_sel_books, "Error selecting from 'books'.", fetch="all"
+    ):
+        BOOK_IDS[isbn if isbn is not None else title] = book_id
+
+
+def api_url(topic, page=0):
+    """Builds the API search URL for a single page of results."""
+
+    return (
+        API_URL
+        + "?"
+        + urllib.parse.urlencode(
+            [("query", topic), ("limit", LIMIT), ("page", page)] + [("fields", f) for f in FIELDS]
+        )
+    )
+
+
+class Feed:
+    """API response that yields each entry of 'results' as it is decoded."""
+
+    #
+    # The response is decompressed and decoded READ_SIZE characters at a time and walked one
+    # JSON token at a time, so beyond the body as it came over the wire, memory is bounded by
+    # the largest single entry rather than the whole decoded page. The other top-level fields
+    # (e.g. 'count' and 'next') are collected in meta as they are reached.
+    #
+
+    def __init__(self, response):
+        encoding = response.info().get_content_charset("utf-8")
+        self.meta = {}
+        self._response = response
+        self._reader = codecs.getreader(encoding)(response)
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+        self._entries = self._parse()
+
+    def __iter__(self):
+        return self._entries
+
+    def finish(self):
+        """Decodes any entries not yet consumed and returns the top-level fields."""
+
+        for _ in self._entries:
+            pass
+
+        return self.meta
+
+    def _parse(self):
+        try:
+            self._expect("{")
+            while self._peek() != "}":
+                key = self._value()
+                self._expect(":")
+                if key == "results":
+                    yield from self._results()
+                else:
+                    self.meta[key] = self._value()
+                if self._expect(",}") == "}":
+                    break
+            # Read to the end of the body so a keep-alive connection can be reused.
+            self._reader.read()
+        except (ValueError, zlib.error) as err:
+            print("Could not decode API response.")
+            logger.error(err)
+            sys.exit()
+        except (http.client.HTTPException, OSError) as err:
+            print("Could not read API response.")
+            logger.error(err)
+            sys.exit()
+        finally:
+            self._response.close()
+
+    def _results(self):
+        self._expect("[")
+        if self._peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._expect(",]") == "]":
+                return
+
+    def _peek(self):
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos].isspace():
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if self._eof:
+                raise ValueError("Unexpected end of response.")
+            self._read()
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars:
+            raise ValueError("Expected one of '" + chars + "' but found '" + char + "'.")
+        self._pos += 1
+        return char
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                if self._eof:
+                    raise
+            else:
+                # A value ending the buffer (e.g. a number) may continue in the next read.
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            self._read()
+
+    def _read(self):
+        chunk = self._reader.read(READ_SIZE)
+        if not chunk:
+            self._eof = True
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+
+
+class ApiClient:
+    """HTTP/1.1 client that reuses keep-alive connections to each host across requests."""
+
+    #
+    # Idle connections are kept per (scheme, host) in a LIFO queue shared by all threads, so
+    # the most recently used (and least likely to have timed out) connection is reused first.
+    # A connection is only returned to the pool once its response has been read in full.
+    #
+    # With a ResponseCache, requests for cached URLs are made conditional on the stored
+    # validators, and a 304 Not Modified is answered with the cached body from disk.
+    #
+    # Like urlopen(), requests time out after HTTP_TIMEOUT, follow redirects, and go through
+    # any proxy set in the environment (http_proxy, https_proxy and no_proxy).
+    #
+
+    def __init__(self, pool_size, cache=None):
+        self.pool_size = pool_size
+        self.cache = cache
+        self.stats = {
+            "requests": 0,
+            "connections": 0,
+            "reused": 0,
+            "not_modified": 0,
+            "bytes_wire": 0,
+            "bytes_decoded": 0,
+        }
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        """Sends a GET request, raising HTTPError or URLError like urllib.request.urlopen()."""
+
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            path = parts.path + ("?" + parts.query if parts.query else "")
+            host = (parts.scheme, parts.netloc)
+
+            headers = {"Accept": "application/json", "Accept-Encoding": "gzip, deflate"}
+            cached = self.cache.lookup(url) if self.cache else None
+            if cached and cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached and cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+            conn, reused = self._checkout(host)
+
+            try:
+                try:
+                    response = self._request(conn, host, path, headers)
+                except (http.client.HTTPException, OSError):
+                    # The server may have closed an idle connection; retry once on a new one.
+                    if not reused:
+                        raise
+                    conn.close()
+                    conn, reused = self._connect(host), False
+                    response = self._request(conn, host, path, headers)
+            except (http.client.HTTPException, OSError) as err:
+                conn.close()
+                raise URLError(err) from err
+
+            self.count("requests")
+
+            if response.status == 304 and cached:
+                response.read()
+                self.release(host, conn, response)
+                self.count("not_modified")
+                return CachedResponse(self, cached)
+
+            if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+                response.read()
+                self.release(host, conn, response)
+                url = urllib.parse.urljoin(url, response.getheader("Location"))
+                continue
+
+            # Anything but a success can't be decoded as a page.
+            if not 200 <= response.status < 300:
+                conn.close()
+                raise HTTPError(url, response.status, response.reason, response.msg, response)
+
+            writer = self.cache.writer(url, response) if self.cache else None
+
+            return PooledResponse(self, host, conn, response, writer)
+
+        raise HTTPError(url, response.status, "Too many redirects", response.msg, response)
+
+    def release(self, host, conn, response):
+        """Returns a connection to its host's pool if its response was read in full."""
+
+        if not response.isclosed() or response.will_close:
+            conn.close()
+            return
+
+        try:
+            self._pool(host).put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _request(self, conn, host, path, headers):
+        # A plain HTTP proxy is sent the full URL; HTTPS goes through a CONNECT tunnel instead.
+        if conn.proxied and host[0] == "http":
+            path = host[0] + "://" + host[1] + path
+        conn.request("GET", path, headers=headers)
+        return conn.getresponse()
+
+    def _checkout(self, host):
+        try:
+            conn = self._pool(host).get_nowait()
+        except queue.Empty:
+            return self._connect(host), False
+
+        self.count("reused")
+        return conn, True
+
+    def _connect(self, host):
+        self.count("connections")
+        scheme, netloc = host
+
+        proxy = self._proxy(scheme, netloc)
+        address = proxy or netloc
+
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(address, timeout=HTTP_TIMEOUT)
+            if proxy:
+                conn.set_tunnel(netloc)
+        else:
+            conn = http.client.HTTPConnection(address, timeout=HTTP_TIMEOUT)
+        conn.proxied = bool(proxy)
+
+        return conn
+
+    def _proxy(self, scheme, netloc):
+        """Returns the host:port of the environment's proxy for a host, or None."""
+
+        proxy = urllib.request.getproxies().get(scheme)
+        if not proxy or urllib.request.proxy_bypass(urllib.parse.urlsplit("//" + netloc).hostname):
+            return None
+
+        parts = urllib.parse.urlsplit(proxy if "://" in proxy else "//" + proxy)
+
+        # Credentials in the proxy URL aren't sent; the proxy must not require them.
+        return parts.hostname + (":" + str(parts.port) if parts.port else "")
+
+    def _pool(self, host):
+        with self._lock:
+            return self._pools.setdefault(host, queue.LifoQueue(maxsize=self.pool_size))
+
+    def count(self, stat, amount=1):
+        """Adds to one of the client's stats."""
+
+        with self._lock:
+            self.stats[stat] += amount
+
+
+class ResponseCache:
+    """On-disk cache of API response bodies and their validators, keyed by full request URL."""
+
+    #
+    # Each URL is stored as two files named after its SHA-256: the body, still compressed as
+    # it came over the wire (or gzipped here if it wasn't), and a JSON file with the URL, the
+    # body's encoding, its Content-Type and the ETag/Last-Modified validators. Entries are
+    # written to temporary files and renamed into place, so a partial body is never served.
+    #
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def lookup(self, url):
+        """Returns the metadata of a cached response for url, or None."""
+
+        try:
+            with open(self._path(url, ".json")) as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+
+        if meta.get("url") != url or not os.path.exists(meta["body"]):
+            return None
+
+        return meta
+
+    def writer(self, url, response):
+        """Returns a CacheWriter for a response, or None if it carries no validators."""
+
+        etag = response.getheader("ETag")
+        last_modified = response.getheader("Last-Modified")
+        if not etag and not last_modified:
+            return None
+
+        encoding = response.getheader("Content-Encoding", "").lower() or "identity"
+        meta = {
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "content_type": response.getheader("Content-Type", "application/json"),
+            "encoding": encoding if encoding in ("gzip", "deflate") else "gzip",
+            "body": self._path(url, ".body"),
+        }
+
+        # Created on first use, so merely importing this module leaves no directory behind.
+        os.makedirs(self.directory, exist_ok=True)
+
+        return CacheWriter(meta, self._path(url, ".json"), compress=encoding != meta["encoding"])
+
+    def _path(self, url, suffix):
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest() + suffix)
+
+
+class CacheWriter:
+    """Tees a response body into a ResponseCache entry as it is read."""
+
+    def __init__(self, meta, meta_path, compress):
+        self._meta = meta
+        self._meta_path = meta_path
+        self._tmp = meta["body"] + "." + str(threading.get_ident()) + ".tmp"
+        self._file = open(self._tmp, "wb")
+        self._compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+
+    def write(self, data):
+        if self._compressor:
+            data = self._compressor.compress(data)
+        self._file.write(data)
+
+    def commit(self):
+        """Moves a complete body and its metadata into place."""
+
+        if self._compressor:
+            self._file.write(self._compressor.flush())
+        self._file.close()
+        os.replace(self._tmp, self._meta["body"])
+
+        with open(self._meta_path + ".tmp", "w") as meta_file:
+            json.dump(self._meta, meta_file)
+        os.replace(self._meta_path + ".tmp", self._meta_path)
+
+    def discard(self):
+        """Throws away an incomplete body."""
+
+        self._file.close()
+        os.remove(self._tmp)
+
+
+class EncodedBody:
+    """File-like body that decompresses gzip or deflate encoded data as it is read.
+
+    read_raw(size) returns up to size bytes of the encoded body, or all of it if size < 0.
+    """
+
+    def __init__(self, client, encoding, read_raw):
+        self._client = client
+        self._read_raw = read_raw
+        self._decompressor = None
+
+        # 32 + MAX_WBITS lets zlib detect either a gzip or a zlib (deflate) header.
+        if encoding.lower() in ("gzip", "deflate"):
+            self._decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+
+    def read(self, size=-1):
+        if self._decompressor is None:
+            data = self._read_raw(size)
+            self._client.count("bytes_decoded", len(data))
+            return data
+
+        # Only return empty data at the end of the body, since readers take it to mean EOF.
+        while True:
+            compressed = self._decompressor.unconsumed_tail or self._read_raw(size)
+            if not compressed:
+                data = self._decompressor.flush()
+            else:
+                data = self._decompressor.decompress(compressed, max(size, 0))
+                if not data:
+                    continue
+            self._client.count("bytes_decoded", len(data))
+            return data
+
+    def buffer(self):
+        """Reads the rest of the encoded body into memory, to be decoded from there."""
+
+        self._read_raw = io.BytesIO(self._read_raw(-1)).read
+
+
+class PooledResponse(EncodedBody):
+    """HTTP response body that hands its connection back to the ApiClient when closed."""
+
+    def __init__(self, client, host, conn, response, writer=None):
+        super().__init__(client, response.getheader("Content-Encoding", ""), self._read_wire)
+        self._host = host
+        self._conn = conn
+        self._response = response
+        self._writer = writer
+        self._complete = False
+
+    def info(self):
+        return self._response.info()
+
+    def buffer(self):
+        """Reads the rest of the body and hands the connection back, raising URLError on failure."""
+
+        try:
+            super().buffer()
+        except (http.client.HTTPException, OSError) as err:
+            raise URLError(err) from err
+        finally:
+            self.close()
+
+    def close(self):
+        if self._conn is None:
+            return
+
+        if self._writer:
+            if self._complete:
+                self._writer.commit()
+            else:
+                self._writer.discard()
+
+        # A body cut off mid-read leaves the connection closed but unusable, so never pool it.
+        if self._complete or not self._response.isclosed():
+            self._client.release(self._host, self._conn, self._response)
+        else:
+            self._conn.close()
+        self._conn = None
+
+    def _read_wire(self, size):
+        data = self._response.read() if size < 0 else self._response.read(size)
+        self._complete = self._response.isclosed()
+        self._client.count("bytes_wire", len(data))
+        if self._writer:
+            self._writer.write(data)
+        return data
+
+
+class CachedResponse(EncodedBody):
+    """Response body replayed from a ResponseCache entry after a 304 Not Modified."""
+
+    def __init__(self, client, meta):
+        self._file = open(meta["body"], "rb")
+        super().__init__(client, meta["encoding"], self._file.read)
+        self._info = http.client.HTTPMessage()
+        self._info["Content-Type"] = meta["content_type"]
+
+    def info(self):
+        return self._info
+
+    def close(self):
+        self._file.close()
+
+
+API_CLIENT = ApiClient(HTTP_POOL_SIZE, ResponseCache(CACHE_DIR) if CACHE_DIR else None)
+
+
+class FetchScheduler:
+    """Paces API requests with a shared token bucket and AIMD-adjusted concurrency."""
+
+    #
+    # Every attempt takes a token and a concurrency slot, both held under one condition. A
+    # throttled or failed attempt halves the concurrency limit and pauses every thread until
+    # the server's Retry-After (or an exponential backoff with jitter) has passed; a healthy
+    # response grows the limit by 1/limit, i.e. by about one slot per limit's worth of requests.
+    #
+    # An attempt lasts until the whole body has been read into memory (it is still decompressed
+    # and decoded incrementally by Feed), so a connection dropped mid-body is retried too.
+    #
+
+    def __init__(self, client, rate, burst, max_concurrency):
+        self.client = client
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.retries = 0
+        self._tokens = float(burst)
+        self._stamp = time.monotonic()
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    def get(self, url):
+        """Sends a GET request through the ApiClient, retrying throttled or failed attempts."""
+
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            self._acquire()
+            start = time.monotonic()
+
+            try:
+                response = self.client.get(url)
+                response.buffer()
+            except HTTPError as err:
+                self._release()
+                if err.code not in RETRY_STATUSES or attempt == MAX_ATTEMPTS:
+                    raise
+                delay = retry_after(err.headers.get("Retry-After")) or backoff(attempt)
+                logger.warning("HTTP %d from API; retrying in %.1fs: %s", err.code, delay, url)
+                self._throttle(delay)
+                continue
+            except URLError as err:
+                self._release()
+                if not isinstance(err.reason, RETRY_ERRORS) or attempt == MAX_ATTEMPTS:
+                    raise
+                delay = backoff(attempt)
+                logger.warning("%s; retrying in %.1fs: %s", err.reason, delay, url)
+                self._throttle(delay)
+                continue
+
+            self._release(time.monotonic() - start)
+            return response
+
+    def _acquire(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+
+                if now < self._paused_until:
+                    self._cond.wait(self._paused_until - now)
+                elif self._in_flight >= int(self.limit):
+                    self._cond.wait()
+                elif self._tokens < 1:
+                    self._cond.wait((1 - self._tokens) / self.rate)
+                else:
+                    self._tokens -= 1
+                    self._in_flight += 1
+                    return
+
+    def _release(self, latency=None):
+        with self._cond:
+            self._in_flight -= 1
+            if latency is not None and latency <= LATENCY_TARGET:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            elif latency is not None:
+                self.limit = max(1.0, self.limit * 0.75)
+            self._cond.notify_all()
+
+    def _throttle(self, delay):
+        with self._cond:
+            self.retries += 1
+            self.limit = max(1.0, self.limit / 2)
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self._cond.notify_all()
+
+
+def retry_after(value):
+    """Returns the delay in seconds requested by a Retry-After header, or None."""
+
+    if not value:
+        return None
+
+    if value.strip().isdigit():
+        return float(value)
 
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
 
-def create_tables(conn):
-    """Drops existing tables and creates new DB scaffolding."""
+    return max(0.0, when.timestamp() - time.time())
 
-    pg_exec(conn, "DROP TABLE IF EXISTS " + ", ".join(DB_TABLES.keys()), "Error dropping tables.")
 
-    # Programatically create tables by looping through DB_TABLES dictionary.
-    for table, rows in DB_TABLES.items():
-        query = sql.SQL("CREATE TABLE {pg_table} " + "( " + ", ".join(rows) + " )").format(
-            pg_table=sql.Identifier(table),
-        )
+def backoff(attempt):
+    """Returns an exponential backoff delay with jitter for a retry attempt."""
 
-        pg_exec(conn, query, "Error creating tables.")
+    return min(60, 2 ** attempt) * random.uniform(0.5, 1)
 
 
-def query_api():
-    """Queries the O'Reilly API endpoint for works based on topic."""
+SCHEDULER = FetchScheduler(API_CLIENT, RATE_LIMIT, RATE_BURST, WORKERS * TOPIC_WORKERS)
 
-    get = (
-        API_URL + "?query=" + TOPIC + "&limit=" + str(LIMIT) + "&fields=" + "&fields=".join(FIELDS)
-    )
-    logger.debug(get)
+
+def fetch_page(url):
+    """Opens a single page of results from the O'Reilly API endpoint for streaming decoding."""
+
+    logger.debug(url)
 
     try:
-        response = urllib.request.urlopen(get)
+        response = SCHEDULER.get(url)
     except HTTPError as err:
         print("There was an HTTP error.")
         logger.error(err)
@@ -104,22 +1550,447 @@ def query_api():
         logger.error(err)
         sys.exit()
 
-    encoding = response.info().get_content_charset("utf-8")
-    feed = json.loads(response.read().decode(encoding))
+    return Feed(response)
+
+
+def query_api(topic, done=None):
+    """Queries the O'Reilly API endpoint for works based on topic, yielding each page of results.
+
+    Yields (page, pages, feed) tuples, where pages is the topic's page count if the API reports
+    one. Each feed must be iterated before the next page is requested. Pages in done, a dict of
+    page -> pages from the checkpoint ledger, are skipped.
+    """
+
+    #
+    # The first page reports the total number of matching works, which gives the number of
+    # pages to fetch. The remaining pages are fetched concurrently and yielded as each one
+    # arrives; at most 2 * WORKERS pages are in flight so a slow loader applies backpressure.
+    # If the API doesn't report a count, fall back to following the 'next' cursor serially,
+    # which means completed pages still have to be fetched to find the next one.
+    #
+
+    done = done or {}
+
+    if done.get(0) is not None:
+        pages = done[0]
+    else:
+        feed = fetch_page(api_url(topic))
+        if 0 not in done:
+            yield 0, None, feed
+        meta = feed.finish()
+
+        if "count" not in meta:
+            page = 0
+            while meta.get("next"):
+                page += 1
+                feed = fetch_page(meta["next"])
+                if page not in done:
+                    yield page, None, feed
+                meta = feed.finish()
+            return
+
+        pages = math.ceil(meta["count"] / LIMIT)
+
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        pending = {}
+        for page in range(1, pages):
+            if page in done:
+                continue
+            pending[pool.submit(fetch_page, api_url(topic, page))] = page
+            if len(pending) < 2 * WORKERS:
+                continue
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                yield pending.pop(future), pages, future.result()
+
+        for future in as_completed(pending):
+            yield pending[future], pages, future.result()
+
+
+def harvest(checkpoints=None):
+    """Harvests all TOPICS concurrently, yielding (kind, value) items for batches() to group.
+
+    Items are ("work", work) for each work unique across topics, ("topic", (key, topic)) for
+    each time a work is found under a topic, and ("page", (topic, page, pages)) once every
+    work of a page has been yielded. Pages already in checkpoints are skipped.
+    """
+
+    #
+    # Each topic is drained by its own thread into a bounded queue of (kind, topic, value)
+    # items: an "entry" for each work, a "page" once all works of a page have been queued, and
+    # an "end" once the topic is done. Works are de-duplicated by book_key() here, in the
+    # consuming thread.
+    #
+
+    checkpoints = checkpoints or {}
+    entries = queue.Queue(maxsize=2 * LIMIT)
+    stop = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=TOPIC_WORKERS)
+    futures = {
+        topic: pool.submit(harvest_topic, topic, entries, stop, checkpoints.get(topic))
+        for topic in TOPICS
+    }
+
+    try:
+        seen = set()
+        remaining = len(futures)
+        while remaining:
+            kind, topic, value = entries.get()
+            if kind == "end":
+                # Re-raises any error that ended the topic early.
+                futures[topic].result()
+                remaining -= 1
+            elif kind == "page":
+                yield "page", (topic,) + value
+            else:
+                key = book_key(value)
+                yield "topic", (key, topic)
+                if key not in seen:
+                    seen.add(key)
+                    yield "work", value
+    finally:
+        stop.set()
+        pool.shutdown()
+
+
+def harvest_topic(topic, entries, stop, done=None):
+    """Puts every work of a topic onto a queue, giving up if the consumer has stopped."""
+
+    try:
+        for page, pages, feed in query_api(topic, done):
+            for entry in feed:
+                if not put_until(entries, ("entry", topic, entry), stop):
+                    return
+            # Page 0 is yielded before its count is known, but its checkpoint must record the
+            # page count so a resumed load can skip fetching it again.
+            if pages is None:
+                count = feed.finish().get("count")
+                pages = math.ceil(count / LIMIT) if count is not None else None
+            if not put_until(entries, ("page", topic, (page, pages)), stop):
+                return
+    finally:
+        put_until(entries, ("end", topic, None), stop)
+
+
+def put_until(items, item, stop):
+    """Puts an item on a bounded queue, giving up (and returning False) once stop is set."""
+
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+
+def batches(items, size):
+    """Groups harvest() items into Batches of up to size works (bar the last)."""
+
+    #
+    # A page is only marked complete in the batch after the one holding its last work, or in
+    # that same batch, so a batch's pages are always durable once it and every batch before it
+    # have been committed. Batches are yielded as soon as they fill, which may be part way
+    # through a page.
+    #
+
+    batch = Batch([], [], [])
+
+    for kind, value in items:
+        if kind == "work":
+            batch.works.append(value)
+        elif kind == "topic":
+            batch.book_topics.append(value)
+        else:
+            batch.pages.append(value)
+        if len(batch.works) == size:
+            yield batch
+            batch = Batch([], [], [])
+
+    if batch.works or batch.book_topics or batch.pages:
+        yield batch
+
+
+def prefetch(iterable, depth):
+    """Runs an iterable in a background thread, yielding its items through a bounded queue."""
+
+    #
+    # This is what overlaps the pipeline's stages: while the caller loads one item, the thread
+    # is already producing the next, up to depth items ahead. Errors in the thread, including
+    # SystemExit, are re-raised in the caller; if the caller stops early, the thread stops and
+    # closes the iterable.
+    #
+
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put_until(items, ("item", item), stop):
+                    return
+        except BaseException as err:
+            put_until(items, ("error", err), stop)
+        else:
+            put_until(items, ("end", None), stop)
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            kind, value = items.get()
+            if kind == "end":
+                return
+            if kind == "error":
+                raise value
+            yield value
+    finally:
+        stop.set()
+        thread.join()
+
+
+class CopyStream:
+    """File-like object that streams rows from an iterable in PostgreSQL's COPY text format."""
+
+    def __init__(self, rows):
+        self._lines = (copy_line(row) for row in rows)
+        self._buffer = ""
 
-    return feed["results"]
+    def read(self, size=-1):
+        """Returns up to size characters of COPY data, or all remaining data if size < 0."""
+
+        chunks = [self._buffer]
+        length = len(self._buffer)
+
+        for line in self._lines:
+            chunks.append(line)
+            length += len(line)
+            if 0 <= size <= length:
+                break
+
+        data = "".join(chunks)
+        if size < 0:
+            self._buffer = ""
+            return data
+
+        self._buffer = data[size:]
+        return data[:size]
+
+
+def copy_line(row):
+    """Renders a tuple of values as a single line of COPY text format."""
+
+    fields = ["\\N" if value is None else str(value).translate(COPY_ESCAPES) for value in row]
+
+    return "\t".join(fields) + "\n"
+
+
+class Statement:
+    """A statement rendered to SQL once per connection, and optionally prepared there.
+
+    Statements with parameter types are PREPAREd on a connection the first time they run on
+    it, with their parameters written as $1, $2, ..., and are then run with EXECUTE. Those
+    without are rendered once and run as plain SQL, e.g. with execute_values().
+    """
+
+    def __init__(self, name, query, types=None):
+        self.name = name
+        self.query = query
+        self.types = types
+
+    def sql(self, conn):
+        """Returns the SQL that runs the statement on conn, preparing it there if needed."""
+
+        rendered = conn.statements.get(self.name)
+        if rendered is not None:
+            return rendered
+
+        rendered = self.query if isinstance(self.query, str) else self.query.as_string(conn)
+
+        if self.types is not None:
+            params = " (" + ", ".join(self.types) + ")" if self.types else ""
+            pg_exec(
+                conn,
+                "PREPARE " + self.name + params + " AS " + rendered,
+                "Error preparing '" + self.name + "'.",
+            )
+            placeholders = ", ".join(["%s"] * len(self.types))
+            rendered = "EXECUTE " + self.name + (" (" + placeholders + ")" if self.types else "")
+
+        conn.statements[self.name] = rendered
+
+        return rendered
+
+
+#
+# The statements run for every batch or every book. Each is rendered once per connection, and
+# those run with a fixed set of parameters are prepared, so the server parses them once and
+# can reuse its plan. Multi-row VALUES statements vary in length, so are only rendered.
+#
+
+BOOK_FIELDS = sql.SQL(",").join(
+    map(sql.Identifier, ["book_id", "title", "isbn", "description", "search_vector"])
+)
+
+SELECT_BOOK_IDS = Statement(
+    "select_book_ids",
+    "SELECT nextval($1) FROM generate_series(1, $2)",
+    types=["regclass", "int"],
+)
+
+INSERT_AUTHORS_STAGED = Statement(
+    "insert_authors_staged",
+    sql.SQL(
+        "INSERT INTO {pg_table} (name) SELECT name FROM {pg_stage} "
+        "ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name RETURNING author_id, name"
+    ).format(pg_table=sql.Identifier("authors"), pg_stage=sql.Identifier("stage_authors")),
+    types=[],
+)
+
+INSERT_AUTHORS_VALUES = Statement(
+    "insert_authors_values",
+    sql.SQL(
+        "INSERT INTO {pg_table} (name) VALUES %s "
+        "ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name RETURNING author_id, name"
+    ).format(pg_table=sql.Identifier("authors")),
+)
+
+INSERT_BOOK = Statement(
+    "insert_book",
+    sql.SQL(
+        "INSERT INTO {pg_table} ({pg_fields}) VALUES ($1, $2, $3, $4, "
+        + SEARCH_VECTOR.format(title="$2", description="$4") + ") " + UPSERT_BOOKS
+    ).format(pg_table=sql.Identifier("books"), pg_fields=BOOK_FIELDS),
+    types=["int", "text", "bigint", "text"],
+)
+
+INSERT_BOOK_AUTHOR = Statement(
+    "insert_book_author",
+    sql.SQL(
+        "INSERT INTO {pg_table} (book_id, author_id) VALUES ($1, $2) ON CONFLICT DO NOTHING"
+    ).format(pg_table=sql.Identifier("books_authors")),
+    types=["int", "int"],
+)
+
+# Deletes relationships to authors a book no longer has.
+DELETE_BOOK_AUTHORS = Statement(
+    "delete_book_authors",
+    sql.SQL("DELETE FROM {pg_table} WHERE book_id = $1 AND NOT author_id = ANY($2)").format(
+        pg_table=sql.Identifier("books_authors"),
+    ),
+    types=["int", "int[]"],
+)
+
+INSERT_BOOKS_STAGED = Statement(
+    "insert_books_staged",
+    sql.SQL(
+        "INSERT INTO {pg_table} ({pg_fields}) SELECT book_id, title, isbn, description, "
+        + SEARCH_VECTOR.format(title="title", description="description")
+        + " FROM {pg_stage} ORDER BY book_id " + UPSERT_BOOKS
+    ).format(
+        pg_table=sql.Identifier("books"),
+        pg_stage=sql.Identifier("stage_books"),
+        pg_fields=BOOK_FIELDS,
+    ),
+    types=[],
+)
+
+INSERT_BOOKS_AUTHORS_STAGED = Statement(
+    "insert_books_authors_staged",
+    sql.SQL(
+        "INSERT INTO {pg_table} (book_id, author_id) "
+        "SELECT DISTINCT book_id, author_id FROM {pg_stage} ON CONFLICT DO NOTHING"
+    ).format(
+        pg_table=sql.Identifier("books_authors"),
+        pg_stage=sql.Identifier("stage_books_authors"),
+    ),
+    types=[],
+)
+
+# Deletes relationships the staged books no longer have.
+DELETE_BOOKS_AUTHORS_STAGED = Statement(
+    "delete_books_authors_staged",
+    sql.SQL(
+        "DELETE FROM {pg_table} ba USING {pg_stage_books} b WHERE ba.book_id = b.book_id "
+        "AND NOT EXISTS (SELECT 1 FROM {pg_stage_links} l "
+        "WHERE l.book_id = ba.book_id AND l.author_id = ba.author_id)"
+    ).format(
+        pg_table=sql.Identifier("books_authors"),
+        pg_stage_books=sql.Identifier("stage_books"),
+        pg_stage_links=sql.Identifier("stage_books_authors"),
+    ),
+    types=[],
+)
+
+INSERT_BOOKS_TOPICS = Statement(
+    "insert_books_topics",
+    sql.SQL(
+        "INSERT INTO {pg_table} (book_id, topic_id) VALUES %s ON CONFLICT DO NOTHING"
+    ).format(pg_table=sql.Identifier("books_topics")),
+)
+
+INSERT_CHECKPOINTS = Statement(
+    "insert_checkpoints",
+    sql.SQL(
+        "INSERT INTO {pg_table} (topic, page, pages) VALUES %s ON CONFLICT DO NOTHING"
+    ).format(pg_table=sql.Identifier("load_checkpoints")),
+)
+
+# Statements that replace the contents of a staging table. TRUNCATE and COPY can't be
+# prepared, so like the VALUES statements they are only rendered.
+StageStatements = collections.namedtuple("StageStatements", ["truncate", "copy", "values"])
+
+
+def stage_statements(table, fields):
+    """Returns the StageStatements that fill fields of a staging table."""
+
+    pg_table = sql.Identifier(table)
+    pg_fields = sql.SQL(",").join(map(sql.Identifier, fields))
+
+    return StageStatements(
+        Statement("truncate_" + table, sql.SQL("TRUNCATE {pg_table}").format(pg_table=pg_table)),
+        Statement(
+            "copy_" + table,
+            sql.SQL("COPY {pg_table} ({pg_fields}) FROM STDIN").format(
+                pg_table=pg_table, pg_fields=pg_fields,
+            ),
+        ),
+        Statement(
+            "values_" + table,
+            sql.SQL("INSERT INTO {pg_table} ({pg_fields}) VALUES %s").format(
+                pg_table=pg_table, pg_fields=pg_fields,
+            ),
+        ),
+    )
+
+
+STAGE_STATEMENTS = {
+    "stage_authors": stage_statements("stage_authors", ["name"]),
+    "stage_books": stage_statements("stage_books", ["book_id", "title", "isbn", "description"]),
+    "stage_books_authors": stage_statements("stage_books_authors", ["book_id", "author_id"]),
+}
 
 
 def pg_exec(conn, postgres_query, msg, **kwargs):
     """Wrapper function for performing PostgreSQL queries and optionally returning values."""
 
-    # Optional arguments that change how SQL is executed and if it returns results.
+    # Optional arguments that change how SQL is executed and if it returns results. Passing
+    # fetch="all" returns every result row instead of just the first.
     fetch = kwargs.get("fetch", None)
     data = kwargs.get("data", None)
     batch = kwargs.get("batch", None)
+    values = kwargs.get("values", None)
+    copy = kwargs.get("copy", None)
 
     #
-    # psycopg2 requires data to be in the form list of tuples:
+    # For a single statement, data is the list of its parameters. In batch, values and copy
+    # modes, psycopg2 requires data to be in the form list of tuples:
     # example = [(field1,), (field2,), ... (fieldN,),]
     #
 
@@ -130,11 +2001,40 @@ def pg_exec(conn, postgres_query, msg, **kwargs):
     # https://www.psycopg.org/docs/extras.html?highlight=batch#psycopg2.extras.execute_batch
     #
 
+    #
+    # Values mode:
+    #   Psycopg will merge the data into a single multi-row VALUES list, so the query must
+    #   contain a single '%s' placeholder in place of the VALUES tuples.
+    # https://www.psycopg.org/docs/extras.html#psycopg2.extras.execute_values
+    #
+
+    #
+    # Copy mode:
+    #   The query is a 'COPY ... FROM STDIN' statement and the data, which may be any iterable
+    #   of tuples including a generator, is streamed to the server without being parsed as SQL.
+    # https://www.psycopg.org/docs/cursor.html#cursor.copy_expert
+    #
+
+    result = None
+
+    # Preparing a Statement is recorded as a statement of its own.
+    if isinstance(postgres_query, Statement):
+        postgres_query = postgres_query.sql(conn)
+
+    start = time.perf_counter()
+
     try:
         cursor = conn.cursor()
         logger.debug(postgres_query)
         if batch:
             execute_batch(cursor, postgres_query, data)
+        elif values:
+            # Results are collected across pages, so they must be fetched here.
+            result = execute_values(
+                cursor, postgres_query, data, page_size=1000, fetch=fetch == "all"
+            )
+        elif copy:
+            cursor.copy_expert(postgres_query, CopyStream(data))
         else:
             if data:
                 cursor.execute(postgres_query, data)
@@ -147,125 +2047,408 @@ def pg_exec(conn, postgres_query, msg, **kwargs):
         conn.close()
         sys.exit()
     else:
-        if fetch:
+        if fetch == "all" and not values:
+            result = cursor.fetchall()
+        elif fetch and fetch != "all":
             result = cursor.fetchone()
-        else:
-            result = None
-        conn.commit()
+        # execute_values() and execute_batch() send nothing for empty data, and only a
+        # statement that reached the server is counted.
+        if cursor.kind is not None:
+            PG_STATS.statement(cursor.kind, time.perf_counter() - start)
+        # In autocommit mode each statement has already committed on its own.
+        if not conn.deferred and not conn.autocommit:
+            conn.commit()
         cursor.close()
 
     return result
 
 
-def dump_authors(conn, works):
-    """Dumps all authors, uniquely, from API query into the PostreSQL DB."""
+def book_isbn(entry):
+    """Returns the ISBN of a work as an integer, or None if it has no usable ISBN."""
 
-    list_of_authors = []
+    isbn = str(entry.get("isbn") or "")
+
+    return int(isbn) if isbn.isdigit() else None
+
+
+def book_key(entry):
+    """Returns the key a work is de-duplicated and matched under: its ISBN, else its title."""
+
+    isbn = book_isbn(entry)
+
+    return isbn if isbn is not None else entry["title"]
+
+
+def assign_book_ids(conn, works):
+    """Returns the book_id of each work, allocating ids for unseen works in a single query."""
+
+    keys = [book_key(entry) for entry in works]
+    new_keys = [key for key in keys if key not in BOOK_IDS]
+
+    if new_keys:
+        new_ids = pg_exec(
+            conn,
+            SELECT_BOOK_IDS,
+            "Error allocating book ids.",
+            fetch="all",
+            data=["books_book_id_seq", len(new_keys)],
+        )
+        for key, (book_id,) in zip(new_keys, new_ids):
+            BOOK_IDS[key] = book_id
+
+    return [BOOK_IDS[key] for key in keys]
+
+
+def author_name(author):
+    """Returns the name an author is stored and looked up under."""
+
+    if NORMALIZE_AUTHORS:
+        return " ".join(unicodedata.normalize("NFKC", author).split())
+
+    return author
+
+
+def author_rows(works):
+    """Yields each distinct author in works once, in order of first appearance, as a 1-tuple."""
+
+    seen = set()
 
-    # Creates a unique list of authors to insert. Generates a list.
     for entry in works:
         for author in entry["authors"]:
-            if author not in list_of_authors:
-                list_of_authors.append(author)
+            name = author_name(author)
+            if name not in seen:
+                seen.add(name)
+                yield (name,)
 
-    query_ins_authors = sql.SQL("INSERT INTO {pg_table} (name) VALUES (%s)").format(
-        pg_table=sql.Identifier("authors"),
-    )
 
-    # Lambda for converting list to list of tuples that psycopg2 expects.
-    pg_exec(
-        conn,
-        query_ins_authors,
-        "Error inserting into 'authors'.",
-        fetch=False,
-        data=list(map(lambda a: tuple([a]), list_of_authors)),
-        batch=True,
-    )
+def dump_authors(conn, works):
+    """Dumps all authors, uniquely, from API query into the PostreSQL DB."""
+
+    #
+    # Only authors missing from AUTHOR_IDS are inserted, and every insert returns the ids of
+    # its authors to fill the cache. Updating the name to itself on conflict makes RETURNING
+    # also report authors that are already in the table but not yet in the cache.
+    #
+
+    # A generator of unique (name,) tuples, consumed directly by the loader.
+    data = (row for row in author_rows(works) if row[0] not in AUTHOR_IDS)
+
+    if LOADER == "copy":
+        stage_rows(conn, "stage_authors", data)
+
+        result = pg_exec(
+            conn, INSERT_AUTHORS_STAGED, "Error inserting into 'authors'.", fetch="all"
+        )
+    else:
+        result = pg_exec(
+            conn,
+            INSERT_AUTHORS_VALUES,
+            "Error inserting into 'authors'.",
+            fetch="all",
+            data=data,
+            values=True,
+        )
+
+    for author_id, name in result:
+        AUTHOR_IDS[name] = author_id
 
 
 def dump_books(conn, works):
-    """Dumps book metadata into PostgreSQL, querying author table for relationship data."""
+    """Dumps book metadata into PostgreSQL one row at a time, linking cached author ids."""
 
     #
     # The table 'books_authors' gives the relationship between books and their authors. For
-    # each book, find the author(s) in the 'author' table and create the relationship.
+    # each book, look up the author(s) in AUTHOR_IDS and create the relationship.
     #
 
-    # SQL to insert data into the 'books' table.
-    query_ins_books = sql.SQL(
-        "INSERT INTO {pg_table} ({pg_fields}) VALUES (%s, %s, %s) RETURNING book_id;"
-    ).format(
-        pg_table=sql.Identifier("books"),
-        pg_fields=sql.SQL(',').join([
-            sql.Identifier('title'),
-            sql.Identifier('isbn'),
-            sql.Identifier('description'),
-        ]),
-    )
-
-    # SQL to select data from the 'authors' table.
-    query_sel_author = sql.SQL("SELECT {pg_fields} FROM {pg_table} WHERE name LIKE %s").format(
-        pg_fields=sql.Identifier("author_id"), pg_table=sql.Identifier("authors"),
-    )
-
-    # SQL to insert data into the 'books_authors' table.
-    query_ins_books_author = sql.SQL(
-        "INSERT INTO {pg_table} ({pg_fields}) VALUES (%s, %s);"
-    ).format(
-        pg_table=sql.Identifier("books_authors"),
-        pg_fields=sql.SQL(",").join([sql.Identifier("book_id"), sql.Identifier("author_id")]),
-    )
-
-    for entry in works:
+    for book_id, entry in zip(assign_book_ids(conn, works), works):
         title = entry["title"]
-        isbn = entry["isbn"] if "isbn" in entry else "0"
+        isbn = book_isbn(entry)
         description = entry["description"]
 
-        #
-        # Insert the book into 'books' table and use the book_id to associate the book
-        # with author(s) in the 'authors' table.
-        #
-        book_id = pg_exec(
+        # Insert or update the book in the 'books' table under its assigned book_id.
+        pg_exec(
             conn,
-            query_ins_books,
+            INSERT_BOOK,
             "Error inserting into 'books'.",
-            fetch=True,
-            data=[(title,), (isbn,), (description,),],
+            data=[book_id, title, isbn, description],
         )
 
         logger.debug("Title: %s; ID: %s", title, book_id)
 
-        for author in entry["authors"]:
-            #
-            # Find the author(s) in the 'authors' table, and use the author_id to associate the
-            # author with a book_id in the 'books' table.
-            #
-            author_id = pg_exec(
-                conn,
-                query_sel_author,
-                "Error selecting from 'authors'.",
-                fetch=True,
-                data=[(author,),],
-            )
+        author_ids = []
+
+        for author in map(author_name, entry["authors"]):
+            # Use the cached author_id to associate the author with a book_id in 'books'.
+            author_id = AUTHOR_IDS[author]
+            author_ids.append(author_id)
 
             logger.debug("Author: %s; ID: %s", author, author_id)
 
             pg_exec(
                 conn,
-                query_ins_books_author,
+                INSERT_BOOK_AUTHOR,
                 "Error inserting into 'books_authors'.",
-                data=[(book_id,), (author_id,),],
+                data=[book_id, author_id],
+            )
+
+        if SYNC_MODE:
+            pg_exec(
+                conn,
+                DELETE_BOOK_AUTHORS,
+                "Error deleting from 'books_authors'.",
+                data=[book_id, author_ids],
             )
 
 
-if DEBUG:
-    logzero.loglevel()
-else:
-    logzero.loglevel(0)
+def dump_topics(conn):
+    """Dumps TOPICS into the PostgreSQL DB, caching their ids in TOPIC_IDS."""
+
+    query_ins_topics = sql.SQL(
+        "INSERT INTO {pg_table} (name) VALUES %s "
+        "ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name RETURNING topic_id, name"
+    ).format(pg_table=sql.Identifier("topics"))
+
+    for topic_id, name in pg_exec(
+        conn,
+        query_ins_topics,
+        "Error inserting into 'topics'.",
+        fetch="all",
+        data=[(topic,) for topic in TOPICS],
+        values=True,
+    ):
+        TOPIC_IDS[name] = topic_id
+
+
+def dump_books_topics(conn):
+    """Dumps the topics of every loaded book pending in BOOK_TOPICS into the PostgreSQL DB."""
+
+    # Pairs for books that haven't been loaded yet stay pending for a later call.
+    loaded = [(key, topic) for key, topic in BOOK_TOPICS if key in BOOK_IDS]
+    BOOK_TOPICS[:] = [(key, topic) for key, topic in BOOK_TOPICS if key not in BOOK_IDS]
+
+    pg_exec(
+        conn,
+        INSERT_BOOKS_TOPICS,
+        "Error inserting into 'books_topics'.",
+        data=[(BOOK_IDS[key], TOPIC_IDS[topic]) for key, topic in set(loaded)],
+        values=True,
+    )
+
+
+def load_works(conn, batch):
+    """Loads a Batch of works and their authors with the configured LOADER."""
+
+    BOOK_TOPICS.extend(batch.book_topics)
+    works = batch.works
+
+    dump_authors(conn, works)
+    if LOADER != "rows":
+        dump_books_bulk(conn, works)
+    else:
+        dump_books(conn, works)
+    dump_books_topics(conn)
+
+    # Checkpoints only matter when chunks are committed as they load.
+    if CHUNK_SIZE:
+        PAGES_DONE.extend(batch.pages)
+        dump_checkpoints(conn)
+
+
+def load_works_parallel(conn, pool, batch):
+    """Loads a Batch of works by partitioning its books over the connections of a pool."""
+
+    #
+    # Authors and book ids are resolved and committed up front on the main connection, so the
+    # partitions only read the caches and never insert into the same rows.
+    #
+
+    BOOK_TOPICS.extend(batch.book_topics)
+    PAGES_DONE.extend(batch.pages)
+    works = batch.works
+
+    with transaction(conn):
+        dump_authors(conn, works)
+        assign_book_ids(conn, works)
+
+    partitions = [works[i::LOAD_CONNECTIONS] for i in range(LOAD_CONNECTIONS)]
+
+    with ThreadPoolExecutor(max_workers=LOAD_CONNECTIONS) as executor:
+        futures = [executor.submit(load_partition, pool, partition) for partition in partitions]
+        for future in futures:
+            future.result()
+
+    with transaction(conn):
+        dump_books_topics(conn)
+        dump_checkpoints(conn)
+
+
+def load_partition(pool, works):
+    """Loads the books of a partition of works over a connection borrowed from a pool."""
+
+    conn = pool.getconn()
+
+    with transaction(conn):
+        if LOADER != "rows":
+            if not conn.staged:
+                create_stage_tables(conn)
+            dump_books_bulk(conn, works)
+        else:
+            dump_books(conn, works)
+
+    pool.putconn(conn)
+
+
+def create_stage_tables(conn):
+    """Creates the session-local staging tables used by the bulk loaders."""
+
+    for table, rows in STAGE_TABLES.items():
+        query = sql.SQL("CREATE TEMP TABLE {pg_table} " + "( " + ", ".join(rows) + " )").format(
+            pg_table=sql.Identifier(table),
+        )
+
+        pg_exec(conn, query, "Error creating staging tables.")
+
+    conn.staged = True
+
+
+def stage_rows(conn, table, data):
+    """Replaces the contents of a staging table with rows, using COPY or multi-row INSERTs."""
+
+    statements = STAGE_STATEMENTS[table]
+
+    pg_exec(conn, statements.truncate, "Error truncating '" + table + "'.")
+
+    if LOADER == "copy":
+        pg_exec(conn, statements.copy, "Error staging '" + table + "'.", data=data, copy=True)
+    else:
+        pg_exec(conn, statements.values, "Error staging '" + table + "'.", data=data, values=True)
+
+
+def dump_books_bulk(conn, works):
+    """Dumps book metadata into PostgreSQL with set-based statements via staging tables."""
+
+    #
+    # Rather than a round trip per book and per author, every book and (book, author) pair
+    # is staged in a single statement each, with book ids from assign_book_ids() and author
+    # ids from AUTHOR_IDS. Staged books are then upserted into 'books', and 'books_authors'
+    # gains any missing pairs. In SYNC_MODE, pairs the staged books no longer have are removed.
+    #
+
+    books = []
+    books_authors = []
+
+    for book_id, entry in zip(assign_book_ids(conn, works), works):
+        books.append((book_id, entry["title"], book_isbn(entry), entry["description"]))
+        for author in entry["authors"]:
+            books_authors.append((book_id, AUTHOR_IDS[author_name(author)]))
+
+    stage_rows(conn, "stage_books", books)
+    stage_rows(conn, "stage_books_authors", books_authors)
+    pg_exec(conn, INSERT_BOOKS_STAGED, "Error inserting into 'books'.")
+    pg_exec(conn, INSERT_BOOKS_AUTHORS_STAGED, "Error inserting into 'books_authors'.")
+    if SYNC_MODE:
+        pg_exec(conn, DELETE_BOOKS_AUTHORS_STAGED, "Error deleting from 'books_authors'.")
+
+
+def main():
+    """Harvests every topic and loads it into PostgreSQL."""
+
+    if DEBUG:
+        logzero.loglevel()
+    else:
+        logzero.loglevel(0)
+
+    pg_conn = db_connect()
+
+    #
+    # Either the whole reload is one transaction, so readers never see a partial catalog, or the
+    # scaffolding is committed first and works are then committed CHUNK_SIZE at a time.
+    # Chunked loads record their progress, so an interrupted one resumes where it left off.
+    # With SWAP_TABLES, either kind loads into shadow tables, swapped in by a final short
+    # transaction, or at the very end of the single one.
+    #
+    # Harvesting runs as a pipeline: topic threads fetch and decode pages, a prefetch thread
+    # de-duplicates and groups works into batches, and this thread loads them, with a bounded
+    # queue between each stage.
+    #
+    if CHUNK_SIZE:
+        with transaction(pg_conn):
+            if swap_mode():
+                create_load_schema(pg_conn)
+            pg_checkpoints = load_checkpoints(pg_conn)
+            if pg_checkpoints:
+                logger.info("Resuming load; %d topic(s) partly loaded.", len(pg_checkpoints))
+            create_tables(pg_conn, keep=bool(pg_checkpoints))
+            if LOADER != "rows":
+                create_stage_tables(pg_conn)
+        pg_pool = db_connect(LOAD_CONNECTIONS) if LOAD_CONNECTIONS > 1 else None
+        pg_batches = batches(harvest(pg_checkpoints), CHUNK_SIZE)
+        for oreilly_batch in prefetch(pg_batches, PIPELINE_DEPTH):
+            if pg_pool:
+                load_works_parallel(pg_conn, pg_pool, oreilly_batch)
+                continue
+            with transaction(pg_conn):
+                load_works(pg_conn, oreilly_batch)
+        with transaction(pg_conn):
+            dump_books_topics(pg_conn)
+            if swap_mode():
+                set_logged(pg_conn)
+            create_indexes(pg_conn)
+            create_search_function(pg_conn)
+        # Not in a transaction, so writers to live tables aren't blocked while keys validate.
+        if BULK_LOAD:
+            create_foreign_keys(pg_conn)
+        with transaction(pg_conn):
+            if swap_mode():
+                swap_tables(pg_conn)
+            clear_checkpoints(pg_conn)
+        if pg_pool:
+            pg_pool.closeall()
+    else:
+        with transaction(pg_conn):
+            if swap_mode():
+                create_load_schema(pg_conn)
+            create_tables(pg_conn)
+            if LOADER != "rows":
+                create_stage_tables(pg_conn)
+            for oreilly_batch in prefetch(batches(harvest(), LIMIT), PIPELINE_DEPTH):
+                load_works(pg_conn, oreilly_batch)
+            dump_books_topics(pg_conn)
+            if swap_mode():
+                set_logged(pg_conn)
+            create_indexes(pg_conn)
+            create_search_function(pg_conn)
+            if BULK_LOAD:
+                create_foreign_keys(pg_conn)
+            if swap_mode():
+                swap_tables(pg_conn)
+
+    # Runs against the live tables, once they're committed.
+    maintain_tables(pg_conn)
+
+    pg_conn.close()
+
+    logger.info(
+        "API requests: %d; connections opened: %d; connections reused: %d; not modified: %d",
+        API_CLIENT.stats["requests"],
+        API_CLIENT.stats["connections"],
+        API_CLIENT.stats["reused"],
+        API_CLIENT.stats["not_modified"],
+    )
+    logger.info(
+        "API retries: %d; final concurrency limit: %.1f", SCHEDULER.retries, SCHEDULER.limit
+    )
+    logger.info(
+        "API bytes on the wire: %d; bytes decoded: %d",
+        API_CLIENT.stats["bytes_wire"],
+        API_CLIENT.stats["bytes_decoded"],
+    )
+
+    PG_STATS.log_summary()
+    if METRICS_FILE:
+        PG_STATS.write_metrics(METRICS_FILE)
+
 
-pg_conn = db_connect()
-create_tables(pg_conn)
-oreilly_works = query_api()
-dump_authors(pg_conn, oreilly_works)
-dump_books(pg_conn, oreilly_works)
-pg_conn.close()
+if __name__ == "__main__":
+    main()
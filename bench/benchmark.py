@@ -0,0 +1,413 @@
+#!/usr/bin/env python3
+
+"""
+This script benchmarks the stages of bootstrap.py against a throwaway PostgreSQL cluster.
+
+A temporary cluster is created with initdb and pg_ctl, and each catalog size is served by
+mock_api.py, harvested alone by one fresh process and loaded with bootstrap.main() by another,
+so each reports its own peak RSS. Results are written as JSON; pass --baseline with an earlier
+result file to compare against it.
+"""
+
+__author__ = "Bradley Frank"
+
+import argparse
+import datetime
+import functools
+import importlib
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import logzero
+from logzero import logger
+
+import mock_api
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(BENCH_DIR), "app")
+
+# Catalog sizes benchmarked by default, in works.
+SIZES = [1000, 10000, 100000]
+
+# Role and database of the throwaway cluster; bootstrap.py names its database after the user.
+DB_USER = "bench"
+
+#
+# Functions of bootstrap.py timed as stages while its main() runs, each with a count of the
+# rows a call handles: the change in one of its caches, or None for steps over whole tables,
+# which count every book.
+#
+STAGES = {
+    "create_tables": None,
+    "dump_authors": lambda bootstrap: len(bootstrap.AUTHOR_IDS),
+    "dump_books": lambda bootstrap: len(bootstrap.BOOK_IDS),
+    "dump_books_bulk": lambda bootstrap: len(bootstrap.BOOK_IDS),
+    "dump_books_topics": lambda bootstrap: -len(bootstrap.BOOK_TOPICS),
+    "dump_checkpoints": lambda bootstrap: -len(bootstrap.PAGES_DONE),
+    "set_logged": None,
+    "create_indexes": None,
+    "create_foreign_keys": None,
+    "swap_tables": None,
+    "maintain_tables": None,
+}
+
+
+class Stages:
+    """Accumulates the time, rows, round trips and peak RSS growth of each stage over a run."""
+
+    #
+    # Stages may run on several threads at once (e.g. with LOAD_CONNECTIONS > 1), in which
+    # case their seconds add up across threads and round trips include the other threads'.
+    # A stage called from within another (e.g. create_foreign_keys() by create_tables()) is
+    # counted as part of the outer one.
+    #
+
+    def __init__(self, bootstrap):
+        self.bootstrap = bootstrap
+        self.stats = {
+            stage: {"seconds": 0.0, "rows": 0, "round_trips": 0, "peak_rss_growth_kb": 0}
+            for stage in STAGES
+        }
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def wrap(self):
+        """Replaces each stage function of bootstrap with one that measures its calls."""
+
+        for stage, count in STAGES.items():
+            setattr(self.bootstrap, stage, self._measured(stage, count))
+
+    def _measured(self, stage, count):
+        func = getattr(self.bootstrap, stage)
+
+        @functools.wraps(func)
+        def measured(*args, **kwargs):
+            if getattr(self._local, "active", False):
+                return func(*args, **kwargs)
+
+            rows = count(self.bootstrap) if count else 0
+            round_trips = self.bootstrap.PG_STATS.round_trips()
+            peak = peak_rss_kb()
+            start = time.perf_counter()
+            self._local.active = True
+
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.active = False
+                with self._lock:
+                    stat = self.stats[stage]
+                    stat["seconds"] += time.perf_counter() - start
+                    stat["round_trips"] += self.bootstrap.PG_STATS.round_trips() - round_trips
+                    stat["peak_rss_growth_kb"] += peak_rss_kb() - peak
+                    if count:
+                        stat["rows"] += count(self.bootstrap) - rows
+                    else:
+                        stat["rows"] += len(self.bootstrap.BOOK_IDS)
+
+        return measured
+
+    def report(self):
+        """Returns the stats of every stage that ran, with their throughput."""
+
+        self.stats["commit"] = {
+            "seconds": self.bootstrap.PG_STATS.commit_seconds,
+            "rows": 0,
+            "round_trips": self.bootstrap.PG_STATS.commits,
+            "peak_rss_growth_kb": 0,
+        }
+
+        report = {}
+
+        for stage, stat in self.stats.items():
+            if not stat["round_trips"] and not stat["seconds"]:
+                continue
+            seconds = stat["seconds"]
+            stat["rows_per_second"] = round(stat["rows"] / seconds) if seconds else 0
+            stat["seconds"] = round(stat["seconds"], 4)
+            report[stage] = stat
+
+        return report
+
+
+def peak_rss_kb():
+    """Returns the peak resident set size of this process so far, in KiB."""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports KiB, macOS bytes.
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def import_bootstrap():
+    """Imports bootstrap.py, set up to fetch from the mock API as fast as it answers."""
+
+    sys.path.insert(0, APP_DIR)
+    bootstrap = importlib.import_module("bootstrap")
+
+    logzero.loglevel(logging.INFO)
+    bootstrap.DEBUG = False
+
+    # RATE_LIMIT is there to spare the real API; the mock takes whatever it's sent.
+    bootstrap.API_CLIENT = bootstrap.ApiClient(bootstrap.HTTP_POOL_SIZE)
+    bootstrap.SCHEDULER = bootstrap.FetchScheduler(
+        bootstrap.API_CLIENT, 10000, 10000, bootstrap.WORKERS * bootstrap.TOPIC_WORKERS
+    )
+
+    return bootstrap
+
+
+def run_harvest(works):
+    """Harvests a catalog from the mock API with bootstrap.py, without loading it."""
+
+    #
+    # This runs in a process of its own, and works are counted and dropped as they are
+    # decoded, so peak RSS is that of the streaming harvest alone.
+    #
+
+    bootstrap = import_bootstrap()
+    start = time.perf_counter()
+    rows = sum(1 for kind, _ in bootstrap.harvest() if kind == "work")
+    seconds = time.perf_counter() - start
+
+    return {
+        "seconds": round(seconds, 4),
+        "rows": rows,
+        "rows_per_second": round(rows / seconds) if seconds else 0,
+        "round_trips": bootstrap.API_CLIENT.stats["requests"],
+        "process_peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def run_main(works):
+    """Runs bootstrap.main() against the mock API, timing it and each of its stages."""
+
+    #
+    # main() runs as configured (transactions, CHUNK_SIZE, the pipeline, SWAP_TABLES), so its
+    # stages overlap with harvesting; the harvest is timed on its own by run_harvest(). Round
+    # trips are those to PostgreSQL, as counted by bootstrap.PG_STATS.
+    #
+
+    bootstrap = import_bootstrap()
+    stages = Stages(bootstrap)
+    stages.wrap()
+
+    start = time.perf_counter()
+    bootstrap.main()
+    seconds = time.perf_counter() - start
+
+    return {
+        "works": works,
+        "books": len(bootstrap.BOOK_IDS),
+        "authors": len(bootstrap.AUTHOR_IDS),
+        "loader": bootstrap.LOADER,
+        "chunk_size": bootstrap.CHUNK_SIZE,
+        "swap_tables": bootstrap.SWAP_TABLES,
+        "seconds": round(seconds, 4),
+        "process_peak_rss_kb": peak_rss_kb(),
+        "stages": stages.report(),
+        "statements": bootstrap.PG_STATS.kinds,
+    }
+
+
+# Benchmarks each run in a process of its own, by name.
+CHILDREN = {"harvest": run_harvest, "main": run_main}
+
+
+def pg_bindir():
+    """Returns the directory of the PostgreSQL server binaries."""
+
+    initdb = shutil.which("initdb")
+    if initdb:
+        return os.path.dirname(initdb)
+
+    try:
+        return subprocess.run(
+            ["pg_config", "--bindir"], check=True, stdout=subprocess.PIPE, universal_newlines=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        print("Could not find initdb; put the PostgreSQL binaries on PATH.")
+        sys.exit()
+
+
+def free_port():
+    """Returns a TCP port on localhost that nothing is listening on."""
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def temp_cluster(bindir):
+    """Runs a throwaway PostgreSQL cluster in a temporary directory, yielding its port."""
+
+    port = free_port()
+
+    with tempfile.TemporaryDirectory(prefix="oreilly-bench-") as directory:
+        data = os.path.join(directory, "data")
+        options = "-p {} -k {} -c listen_addresses=127.0.0.1".format(port, directory)
+
+        subprocess.run(
+            [os.path.join(bindir, "initdb"), "-D", data, "-U", DB_USER, "-A", "trust", "-N"],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        subprocess.run(
+            [os.path.join(bindir, "pg_ctl"), "-D", data, "-l", os.path.join(directory, "log"),
+             "-o", options, "-w", "start"],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+
+        try:
+            subprocess.run(
+                [os.path.join(bindir, "createdb"), "-h", "127.0.0.1", "-p", str(port),
+                 "-U", DB_USER, DB_USER],
+                check=True,
+            )
+            yield port
+        finally:
+            subprocess.run(
+                [os.path.join(bindir, "pg_ctl"), "-D", data, "-m", "fast", "-w", "stop"],
+                check=False,
+                stdout=subprocess.DEVNULL,
+            )
+
+
+def run_size(works, port, seed):
+    """Serves a catalog of works from the mock API and benchmarks harvesting and loading it."""
+
+    catalog = mock_api.Catalog(works, max(1, works // 3), seed=seed)
+    server = mock_api.MockServer(("127.0.0.1", 0), catalog)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    env = dict(
+        os.environ,
+        POSTGRES_USER=DB_USER,
+        POSTGRES_PASSWORD="",
+        POSTGRES_HOST="127.0.0.1",
+        POSTGRES_PORT=str(port),
+        OREILLY_API_URL=server.url,
+    )
+
+    def child(name):
+        with tempfile.NamedTemporaryFile(mode="r", suffix=".json") as output:
+            subprocess.run(
+                [sys.executable, __file__, "--child", name, str(works), "--output", output.name],
+                check=True,
+                env=env,
+            )
+            return json.load(output)
+
+    try:
+        harvest = child("harvest")
+        run = child("main")
+        run["stages"] = dict(query_api=harvest, **run["stages"])
+        return run
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def compare(results, baseline):
+    """Logs the change in time of each stage against a baseline result file."""
+
+    before = {run["works"]: run for run in baseline["runs"]}
+
+    for run in results["runs"]:
+        if run["works"] not in before:
+            continue
+        stages = dict(run["stages"], main=run)
+        for stage, stat in stages.items():
+            old = dict(before[run["works"]]["stages"], main=before[run["works"]]).get(stage)
+            if not old or not old["seconds"]:
+                continue
+            logger.info(
+                "%7d works %-18s %9.3fs -> %9.3fs (%+.1f%%)",
+                run["works"],
+                stage,
+                old["seconds"],
+                stat["seconds"],
+                (stat["seconds"] / old["seconds"] - 1) * 100,
+            )
+
+
+def describe():
+    """Returns the versions under test."""
+
+    def output(*command):
+        try:
+            return subprocess.run(
+                command, check=True, stdout=subprocess.PIPE, universal_newlines=True, cwd=BENCH_DIR
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    return {
+        "commit": output("git", "rev-parse", "HEAD"),
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "postgres": output(os.path.join(pg_bindir(), "postgres"), "--version"),
+    }
+
+
+def parse_args():
+    """Parses command line options."""
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "sizes", nargs="*", type=int, default=SIZES, help="catalog sizes to load, in works"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic catalogs")
+    parser.add_argument("--output", help="file to write results to (default: stdout)")
+    parser.add_argument("--baseline", help="earlier result file to compare against")
+    parser.add_argument("--child", choices=CHILDREN, help=argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+
+def main():
+    """Benchmarks every catalog size and writes the results."""
+
+    args = parse_args()
+
+    if args.child:
+        with open(args.output, "w") as output:
+            json.dump(CHILDREN[args.child](args.sizes[0]), output)
+        return
+
+    results = describe()
+    results["runs"] = []
+
+    with temp_cluster(pg_bindir()) as port:
+        for works in args.sizes:
+            logger.info("Benchmarking %d works.", works)
+            results["runs"].append(run_size(works, port, args.seed))
+            logger.info("Loaded %d works in %.1fs.", works, results["runs"][-1]["seconds"])
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+"""
+This script serves a local stand-in for the O'Reilly search API, backed by a synthetic catalog.
+
+Point bootstrap.py at it with OREILLY_API_URL=http://localhost:8000/api/v2/search/.
+"""
+
+__author__ = "Bradley Frank"
+
+import argparse
+import gzip
+import hashlib
+import itertools
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+from logzero import logger
+
+# Vocabulary for synthetic names, titles and descriptions.
+FIRST_NAMES = [
+    "Ada", "Alex", "Brian", "Carol", "David", "Elena", "Fatima", "Grace", "Hiro", "Ines",
+    "James", "Julia", "Kenji", "Laura", "Luciano", "Maria", "Mark", "Nina", "Omar", "Priya",
+    "Ravi", "Sarah", "Tomás", "Wei", "Zoë",
+]
+LAST_NAMES = [
+    "Adams", "Beazley", "Chen", "Díaz", "Evans", "Fischer", "García", "Hughes", "Ito", "Jones",
+    "Kumar", "Lutz", "Martelli", "Nguyen", "Okafor", "Petrov", "Ramalho", "Schmidt", "Tanaka",
+    "Van Rossum", "Wang", "Xu", "Yilmaz", "Zhang",
+]
+WORDS = [
+    "python", "data", "learning", "systems", "cloud", "security", "design", "patterns",
+    "programming", "distributed", "analysis", "machine", "network", "practical", "modern",
+    "performance", "testing", "concurrency", "web", "services", "architecture", "guide",
+    "fluent", "effective", "operations", "infrastructure", "automation", "deep", "scalable",
+]
+
+# Search results are sorted and paginated like the real API, with up to this many per page.
+MAX_LIMIT = 200
+
+
+class Catalog:
+    """Deterministic synthetic catalog, generated work by work on demand."""
+
+    #
+    # Work i is always generated from the same seeded RNG, so pages can be served in any order
+    # without holding the catalog in memory. Authors are drawn from a Zipfian distribution, so
+    # a few prolific authors appear on many works, as in the real catalog.
+    #
+
+    def __init__(self, works, authors, seed=0, missing_isbn=0.05, topic_share=1.0):
+        self.works = works
+        self.authors = authors
+        self.seed = seed
+        self.missing_isbn = missing_isbn
+        self.topic_share = topic_share
+        self._cum_weights = list(
+            itertools.accumulate(1 / rank ** 1.1 for rank in range(1, authors + 1))
+        )
+        self._topics = {}
+        self._lock = threading.Lock()
+
+    def key(self):
+        """Returns every parameter the catalog's contents depend on."""
+
+        return (self.works, self.authors, self.seed, self.missing_isbn, self.topic_share)
+
+    def topic(self, query):
+        """Returns the indexes of the works matching a query."""
+
+        with self._lock:
+            if query not in self._topics:
+                digest = hashlib.sha256(query.encode()).hexdigest()
+                rng = random.Random(self.seed + int(digest, 16))
+                self._topics[query] = [
+                    i for i in range(self.works) if rng.random() < self.topic_share
+                ]
+            return self._topics[query]
+
+    def work(self, index):
+        """Returns the full record of work index."""
+
+        rng = random.Random(self.seed * 1000003 + index)
+
+        title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 6))).title()
+        authors = rng.choices(
+            range(self.authors), cum_weights=self._cum_weights, k=rng.randint(1, 3)
+        )
+
+        # Descriptions are log-normally distributed around a few hundred characters.
+        length = int(rng.lognormvariate(6.2, 0.6))
+        description = []
+        while sum(map(len, description)) + len(description) < length:
+            description.append(rng.choice(WORDS))
+
+        work = {
+            "title": title,
+            "authors": [author_name(author) for author in dict.fromkeys(authors)],
+            "description": " ".join(description).capitalize() + ".",
+        }
+        if rng.random() >= self.missing_isbn:
+            work["isbn"] = str(9780000000000 + index)
+
+        return work
+
+
+def author_name(index):
+    """Returns the synthetic name of author index."""
+
+    first = FIRST_NAMES[index % len(FIRST_NAMES)]
+    last = LAST_NAMES[(index // len(FIRST_NAMES)) % len(LAST_NAMES)]
+    suffix = index // (len(FIRST_NAMES) * len(LAST_NAMES))
+
+    return first + " " + last + (" " + str(suffix + 1) if suffix else "")
+
+
+class Throttle:
+    """Server-side token bucket, rejecting requests beyond rate per second."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = float(rate)
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Takes a token if one is available."""
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    """Handles GET requests for the search endpoint of a MockServer."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        """Serves a page of search results, or an injected failure."""
+
+        server = self.server
+        parts = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(parts.query)
+
+        if server.latency:
+            time.sleep(random.expovariate(1000 / server.latency))
+
+        if server.throttle and not server.throttle.allow():
+            self._send(429, b"", {"Retry-After": "1"})
+            return
+
+        # Only statuses bootstrap.py retries, so injected errors exercise its retries.
+        if random.random() < server.error_rate:
+            self._send(random.choice([502, 503, 504]), b"", {"Retry-After": "1"})
+            return
+
+        if parts.path.rstrip("/") != server.path.rstrip("/"):
+            self._send(404, b"")
+            return
+
+        query = params.get("query", [""])[0]
+        limit = min(int(params.get("limit", ["10"])[0]), MAX_LIMIT)
+        page = int(params.get("page", ["0"])[0])
+        fields = params.get("fields") or ["isbn", "authors", "title", "description"]
+
+        matches = server.catalog.topic(query)
+        digest = hashlib.sha256(repr((server.catalog.key(), self.path)).encode()).hexdigest()
+        etag = '"' + digest + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self._send(304, b"", {"ETag": etag})
+            return
+
+        results = []
+        for index in matches[page * limit:(page + 1) * limit]:
+            work = server.catalog.work(index)
+            results.append({field: work[field] for field in fields if field in work})
+
+        next_url = None
+        if (page + 1) * limit < len(matches):
+            params["page"] = [str(page + 1)]
+            next_url = "http://" + self.headers.get("Host", "localhost") + parts.path + "?" + (
+                urllib.parse.urlencode(params, doseq=True)
+            )
+
+        body = json.dumps({"results": results, "count": len(matches), "next": next_url}).encode()
+        headers = {"Content-Type": "application/json; charset=utf-8", "ETag": etag}
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+
+        self._send(200, body, headers)
+
+    def log_message(self, fmt, *args):
+        logger.debug(fmt, *args)
+
+    def _send(self, status, body, headers=None):
+        self.send_response(status)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockServer(ThreadingHTTPServer):
+    """Threaded HTTP server for a Catalog, with tunable latency, errors and throttling."""
+
+    daemon_threads = True
+
+    def __init__(self, address, catalog, path="/api/v2/search/", latency=0, error_rate=0, rate=0):
+        super().__init__(address, SearchHandler)
+        self.catalog = catalog
+        self.path = path
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle = Throttle(rate) if rate else None
+
+    @property
+    def url(self):
+        """The URL of the search endpoint."""
+
+        host, port = self.server_address[:2]
+        return "http://" + host + ":" + str(port) + self.path
+
+
+def parse_args():
+    """Parses command line options."""
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--works", type=int, default=10000, help="number of works in the catalog")
+    parser.add_argument("--authors", type=int, help="number of distinct authors (works / 3)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic catalog")
+    parser.add_argument(
+        "--missing-isbn", type=float, default=0.05, help="fraction of works without an ISBN"
+    )
+    parser.add_argument(
+        "--topic-share", type=float, default=1.0, help="fraction of works each query matches"
+    )
+    parser.add_argument("--latency", type=float, default=0, help="mean response latency in ms")
+    parser.add_argument(
+        "--error-rate", type=float, default=0, help="fraction of requests failing with 502/503/504"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=0, help="requests per second before answering 429"
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    """Serves a synthetic catalog until interrupted."""
+
+    args = parse_args()
+
+    catalog = Catalog(
+        args.works,
+        args.authors or max(1, args.works // 3),
+        seed=args.seed,
+        missing_isbn=args.missing_isbn,
+        topic_share=args.topic_share,
+    )
+    server = MockServer(
+        (args.host, args.port),
+        catalog,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate=args.rate,
+    )
+
+    logger.info("Serving %d works at %s", args.works, server.url)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()